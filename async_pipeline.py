@@ -0,0 +1,227 @@
+"""
+Pipelined video processing with asyncio
+
+The frames flow through bounded queues between four stages:
+
+    decode -> compute -> lane -> encode
+
+decode reads the source, compute runs the stateless prepare_frame of several
+frames at once in a thread or process pool, lane runs the stateful lane
+update and the drawing in frame order, and encode writes to the sink. Every
+stage runs in its own executor, so decoding, computing and encoding overlap.
+OpenCV releases the GIL, so threads alone run in parallel.
+
+compute puts the futures of the frames in its output queue in frame order,
+so the lane stage sees the frames in order whichever finishes first.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import time
+
+import numpy as np
+
+import pipeline
+from lane import Lane
+from pipeline import FrameContext, prepare_frame, finish_frame
+from profiling import NULL_PROFILER
+
+
+def _timed(function, *args):
+    # Runs in the executor, so the time does not include waiting for a worker
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+class StageStats:
+    def __init__(self, name, workers=1):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy_seconds = 0.0
+
+    def add(self, seconds):
+        self.items += 1
+        self.busy_seconds += seconds
+
+
+class MonitoredQueue(asyncio.Queue):
+    # Records its depth after every put, and how often a put found it full
+    def __init__(self, name, maxsize):
+        super().__init__(maxsize)
+        self.name = name
+        self.depths = []
+        self.full_waits = 0
+
+    async def put(self, item):
+        if self.full():
+            self.full_waits += 1
+        await super().put(item)
+        self.depths.append(self.qsize())
+
+
+class PipelineStats:
+    def __init__(self, stages, queues):
+        self.stages = stages
+        self.queues = queues
+        self.wall_seconds = 0.0
+        self.frames = 0
+
+    def summary(self):
+        summary = collections.OrderedDict()
+        for stage in self.stages:
+            capacity = self.wall_seconds * stage.workers
+            summary[stage.name] = collections.OrderedDict([
+                ('items', stage.items), ('workers', stage.workers),
+                ('busy_s', stage.busy_seconds),
+                ('occupancy', stage.busy_seconds / capacity if capacity else 0.0)])
+        for queue in self.queues:
+            depths = np.array(queue.depths or [0])
+            summary[queue.name] = collections.OrderedDict([
+                ('maxsize', queue.maxsize), ('mean_depth', depths.mean()),
+                ('max_depth', int(depths.max())), ('full_waits', queue.full_waits)])
+        return summary
+
+    def fps(self):
+        return self.frames / self.wall_seconds if self.wall_seconds else 0.0
+
+    def print_summary(self):
+        summary = self.summary()
+        print('{0:<12} {1:>7} {2:>7} {3:>9} {4:>9}'.format(
+            'Stage', 'items', 'workers', 'busy s', 'occupancy'))
+        for stage in self.stages:
+            stats = summary[stage.name]
+            print('{0:<12} {1:7d} {2:7d} {3:9.2f} {4:9.0%}'.format(
+                stage.name, stats['items'], stats['workers'], stats['busy_s'],
+                stats['occupancy']))
+        print('{0:<12} {1:>7} {2:>10} {3:>9} {4:>10}'.format(
+            'Queue', 'maxsize', 'mean depth', 'max depth', 'full waits'))
+        for queue in self.queues:
+            stats = summary[queue.name]
+            print('{0:<12} {1:7d} {2:10.2f} {3:9d} {4:10d}'.format(
+                queue.name, stats['maxsize'], stats['mean_depth'], stats['max_depth'],
+                stats['full_waits']))
+        print('{0} frames, {1:.1f} fps'.format(self.frames, self.fps()))
+
+
+async def _decode(source, out_queue, executor, stats):
+    loop = asyncio.get_running_loop()
+    frames = iter(source)
+    while True:
+        frame, seconds = await loop.run_in_executor(executor, _timed, next, frames, None)
+        if frame is None:
+            break
+        stats.add(seconds)
+        await out_queue.put(frame)
+    await out_queue.put(None)
+
+
+# The FrameContext of each compute thread
+_thread_contexts = threading.local()
+
+def _prepare_frame_in_thread(img, camera):
+    # The context's buffers are reused by the thread's next frame while this
+    # one may still be queued, so the results are copied out of them
+    context = getattr(_thread_contexts, 'context', None)
+    if context is None or context.undist.shape[0:2] != img.shape[0:2]:
+        context = FrameContext(img.shape, reuse_output=False)
+        _thread_contexts.context = context
+    (undist, binary_warped) = prepare_frame(img, camera, context=context)
+    return undist.copy(), binary_warped.copy()
+
+
+async def _compute(in_queue, out_queue, executor, camera, use_processes):
+    loop = asyncio.get_running_loop()
+    while True:
+        frame = await in_queue.get()
+        if frame is None:
+            break
+        if use_processes:
+            future = loop.run_in_executor(
+                executor, _timed, pipeline.prepare_frame_in_worker, frame, False, False)
+        else:
+            future = loop.run_in_executor(executor, _timed, _prepare_frame_in_thread, frame,
+                                          camera)
+        await out_queue.put(future)
+    await out_queue.put(None)
+
+
+async def _lane(in_queue, out_queue, executor, camera, lane_object, compute_stats, stats,
+                use_processes):
+    loop = asyncio.get_running_loop()
+    # A new output frame each time, the encoder may still hold the last ones
+    context = FrameContext(camera.image_shape, reuse_output=False)
+    while True:
+        future = await in_queue.get()
+        if future is None:
+            break
+        prepared, seconds = await future
+        compute_stats.add(seconds)
+        if use_processes:
+            prepared = prepared[0]
+        (undist, binary_warped) = prepared
+        output, seconds = await loop.run_in_executor(
+            executor, _timed, finish_frame, undist, binary_warped, camera, lane_object,
+            NULL_PROFILER, context)
+        stats.add(seconds)
+        await out_queue.put(output)
+    await out_queue.put(None)
+
+
+async def _encode(in_queue, sink, executor, stats):
+    loop = asyncio.get_running_loop()
+    while True:
+        frame = await in_queue.get()
+        if frame is None:
+            break
+        _, seconds = await loop.run_in_executor(executor, _timed, sink.write, frame)
+        stats.add(seconds)
+
+
+async def _process_stream(source, sink, camera, lane_object, executors, stats, use_processes):
+    (decode_stats, compute_stats, lane_stats, encode_stats) = stats.stages
+    (decoded, prepared, drawn) = stats.queues
+    (decode_executor, compute_executor, lane_executor, encode_executor) = executors
+    await asyncio.gather(
+        _decode(source, decoded, decode_executor, decode_stats),
+        _compute(decoded, prepared, compute_executor, camera, use_processes),
+        _lane(prepared, drawn, lane_executor, camera, lane_object, compute_stats, lane_stats,
+              use_processes),
+        _encode(drawn, sink, encode_executor, encode_stats))
+
+
+def process_stream_async(source, sink, camera, compute_workers=2, decode_depth=4,
+                         compute_depth=None, encode_depth=4, use_processes=False):
+    # Like pipeline.process_stream with the stages overlapped. compute_depth
+    # is the number of frames in the compute stage, by default two per
+    # worker. Returns the PipelineStats.
+    if compute_depth is None:
+        compute_depth = 2 * compute_workers
+    lane_object = Lane(camera.image_shape)
+    stats = PipelineStats(
+        [StageStats('decode'), StageStats('compute', compute_workers),
+         StageStats('lane'), StageStats('encode')],
+        [MonitoredQueue('decoded', decode_depth), MonitoredQueue('prepared', compute_depth),
+         MonitoredQueue('drawn', encode_depth)])
+
+    if use_processes:
+        compute_executor = concurrent.futures.ProcessPoolExecutor(
+            compute_workers, initializer=pipeline.init_worker, initargs=(camera,))
+    else:
+        compute_executor = concurrent.futures.ThreadPoolExecutor(compute_workers)
+    executors = (concurrent.futures.ThreadPoolExecutor(1), compute_executor,
+                 concurrent.futures.ThreadPoolExecutor(1),
+                 concurrent.futures.ThreadPoolExecutor(1))
+    start = time.perf_counter()
+    try:
+        asyncio.run(_process_stream(source, sink, camera, lane_object, executors, stats,
+                                    use_processes))
+    finally:
+        for executor in executors:
+            executor.shutdown()
+    stats.wall_seconds = time.perf_counter() - start
+    stats.frames = stats.stages[3].items
+    return stats
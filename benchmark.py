@@ -0,0 +1,324 @@
+"""
+Throughput benchmark of the pipeline stages over test_images and cuts
+
+Runs headless, without display and video encoding:
+
+    python benchmark.py --output results.json --baseline baseline.json
+
+The threshold and warp stages are measured in the order and on the inputs of
+the threshold mode, config.THRESHOLD_MODE or --threshold-mode.
+
+With --check it instead checks that the parallel and optimized paths, and
+the multi-stream LaneTracker, give the results of the reference paths on
+test_images and the first frames of cuts/cut.mp4, and fails if they do not:
+
+    python benchmark.py --check
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import platform
+import sys
+import time
+
+import matplotlib
+matplotlib.use('Agg')
+import cv2
+import numpy as np
+
+# My modules
+import config
+from camera import Camera
+from async_pipeline import process_stream_async
+from frame_io import FrameSink, ImageDirectorySource, VideoCaptureSource
+from lane import Lane
+from lane_tracker import LaneTracker
+import lane_drawing
+import lane_finding
+import pipeline
+import thresholding
+
+
+def measure(function, inputs, warmup, repeats):
+    # Calls function on every input warmup + repeats times,
+    # returns the latencies of the measured calls in seconds
+    for _ in range(warmup):
+        for item in inputs:
+            function(item)
+
+    latencies = []
+    for _ in range(repeats):
+        for item in inputs:
+            start = time.perf_counter()
+            function(item)
+            latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+def statistics(latencies):
+    p50, p95, p99 = np.percentile(latencies * 1000, [50, 95, 99])
+    return {'fps': len(latencies) / latencies.sum(),
+            'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99,
+            'frames': len(latencies)}
+
+
+def threshold_and_warp_stages(camera, mode):
+    # The threshold and warp stages of pipeline.threshold_and_warp in mode,
+    # in the order they run: [(name, function), ...]
+    if mode == 'warped':
+        return [('warp', lambda img: camera.undistort_and_warp(img, cv2.INTER_LINEAR)),
+                ('threshold', thresholding.threshold)]
+    if mode == 'region':
+        threshold = lambda img: thresholding.threshold_region(img, camera.warp_source_region)
+    elif mode == 'full':
+        threshold = thresholding.threshold
+    else:
+        raise ValueError('Unknown threshold mode: ' + mode)
+    return [('threshold', threshold), ('warp', camera.undistort_and_warp)]
+
+
+def benchmark_stages(camera, images, warmup, repeats, mode=None):
+    # The stages of the pipeline in the threshold mode, default config.THRESHOLD_MODE
+    if mode is None:
+        mode = config.THRESHOLD_MODE
+    results = {}
+    undistorted = [camera.undistort(img) for img in images]
+
+    results['undistort'] = measure(camera.undistort, images, warmup, repeats)
+    # Each stage is measured on the outputs of the one before
+    inputs = images
+    for name, function in threshold_and_warp_stages(camera, mode):
+        results[name] = measure(function, inputs, warmup, repeats)
+        inputs = [function(item) for item in inputs]
+    warped = inputs
+    context = pipeline.FrameContext(camera.image_shape, reuse_output=False)
+    results['threshold_and_warp'] = measure(
+        lambda img: pipeline.threshold_and_warp(img, camera, mode, context=context),
+        images, warmup, repeats)
+    results['find_lane_polynomials'] = measure(
+        lane_finding.find_lane_polynomials, warped, warmup, repeats)
+
+    # Lane objects that are up to date, for tracking and drawing
+    lanes = []
+    for undist, binary_warped in zip(undistorted, warped):
+        lane_object = Lane(camera.image_shape)
+        pipeline.finish_frame(undist, binary_warped, camera, lane_object)
+        lanes.append(lane_object)
+    tracked = [(binary_warped, lane_object) for binary_warped, lane_object in zip(warped, lanes)
+               if lane_object.is_trackable()]
+    if tracked:
+        results['find_lane_polynomials_near'] = measure(
+            lambda item: lane_finding.find_lane_polynomials_for_lane(*item),
+            tracked, warmup, repeats)
+    results['draw_all'] = measure(
+        lambda item: lane_drawing.draw_all(item[0], item[1], camera),
+        list(zip(undistorted, lanes)), warmup, repeats)
+    results['process_image'] = measure(
+        lambda img: pipeline.process_image(img, camera), images, warmup, repeats)
+    return results
+
+
+def benchmark_clip(camera, frames, warmup, repeats):
+    # The full video pipeline with lane tracking, frames decoded up front
+    def run(frames):
+        lane_object = Lane(camera.image_shape)
+        latencies = []
+        start = time.perf_counter()
+        for _ in pipeline.process_frames(frames, camera, lane_object):
+            end = time.perf_counter()
+            latencies.append(end - start)
+            start = end
+        return latencies
+
+    for _ in range(warmup):
+        run(frames)
+    latencies = []
+    for _ in range(repeats):
+        latencies += run(frames)
+    return np.array(latencies)
+
+
+class HashSink(FrameSink):
+    # Keeps the sha1 of every frame written, for comparing outputs
+    def __init__(self):
+        self.hashes = []
+
+    def write(self, frame):
+        self.hashes.append(hashlib.sha1(np.ascontiguousarray(frame)).hexdigest())
+
+
+def check_parallel(camera, images, frames):
+    # The process pool of process_stream and the pipelined mode, with threads
+    # and with processes, must write the frames of the serial process_stream
+    reference = HashSink()
+    pipeline.process_stream(frames, reference, camera)
+    runs = [('process_stream workers=3',
+             lambda sink: pipeline.process_stream(frames, sink, camera, workers=3)),
+            ('async threads', lambda sink: process_stream_async(frames, sink, camera, 3)),
+            ('async processes',
+             lambda sink: process_stream_async(frames, sink, camera, 3, use_processes=True))]
+    failures = []
+    for name, run in runs:
+        sink = HashSink()
+        run(sink)
+        differing = (sum(hash != reference_hash for hash, reference_hash
+                         in zip(sink.hashes, reference.hashes))
+                     + abs(len(sink.hashes) - len(reference.hashes)))
+        if differing:
+            failures.append('{0}: {1} of {2} frames differ from the serial run'.format(
+                name, differing, len(reference.hashes)))
+    return failures
+
+
+def check_lookup_table(camera, images, frames):
+    # threshold, through the lookup table, must give the binaries of the HLS
+    # reference thresholding, with the default and with other parameters
+    failures = []
+    other_params = thresholding.ThresholdParams(hue_min=15, hue_max=35,
+                                                saturation_min=60, lightness_min=190)
+    for params in [thresholding.DEFAULT_THRESHOLD_PARAMS, other_params]:
+        differing = sum(np.count_nonzero(thresholding.threshold(img, params=params)
+                                         != thresholding.threshold_hls(img, params=params))
+                        for img in images + frames)
+        if differing:
+            failures.append('{0}: {1} pixels differ from threshold_hls'.format(
+                params, differing))
+    return failures
+
+
+def check_lane_tracker(camera, images, frames):
+    # A LaneTracker must track each stream like a Lane of its own. Stream 0
+    # sees the frames in order, stream 1 in reverse.
+    binary_warpeds = [pipeline.prepare_frame(frame, camera, undistort=False)[1].copy()
+                      for frame in frames]
+    streams = [binary_warpeds, binary_warpeds[::-1]]
+    lanes = [Lane(camera.image_shape) for _ in streams]
+    tracker = LaneTracker(len(streams), camera.image_shape)
+    names = ['age', 'left_poly', 'right_poly', 'radius_of_curvature_m',
+             'relative_car_position_m']
+    failures = []
+    for frame in range(len(binary_warpeds)):
+        ticks = [stream[frame] for stream in streams]
+        for binary_warped, lane_object in zip(ticks, lanes):
+            pipeline.update_lane(binary_warped, lane_object)
+        pipeline.update_lanes(range(len(streams)), ticks, tracker)
+        for stream, lane_object in enumerate(lanes):
+            view = tracker.lane(stream)
+            for name in names:
+                (expected, value) = (getattr(lane_object, name), getattr(view, name))
+                if (expected is None) != (value is None) or (
+                        expected is not None and not np.allclose(value, expected, 1e-9, 1e-12)):
+                    failures.append('stream {0}, frame {1}: {2} is {3}, Lane has {4}'.format(
+                        stream, frame, name, value, expected))
+    return failures
+
+
+# (name, function(camera, images, frames) returning the failure messages)
+CHECKS = [
+    ('parallel output', check_parallel),
+    ('threshold lookup table', check_lookup_table),
+    ('lane tracker', check_lane_tracker),
+]
+
+def run_checks(camera, images, frames):
+    # Returns whether every check passed
+    passed = True
+    for name, check in CHECKS:
+        failures = check(camera, images, frames)
+        print('{0:<40} {1}'.format(name, 'FAILED' if failures else 'OK'))
+        for failure in failures[:10]:
+            print('    ' + failure)
+        if len(failures) > 10:
+            print('    and {0} more'.format(len(failures) - 10))
+        passed = passed and not failures
+    return passed
+
+
+def compare(results, baseline, tolerance):
+    # Names of the benchmarks whose fps dropped more than tolerance
+    regressions = []
+    for name, stats in results.items():
+        if name in baseline and stats['fps'] < baseline[name]['fps'] * (1 - tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--images', default='test_images/*.jpg')
+    parser.add_argument('--clips', default='cuts/*.mp4')
+    parser.add_argument('--max-frames', type=int, default=100,
+                        help='maximum number of frames used from each clip')
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', help='JSON file for the results')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed relative fps drop against the baseline')
+    parser.add_argument('--threshold-mode', choices=['warped', 'full', 'region'],
+                        help='order of thresholding and warping, see config.py '
+                             '(default: config.THRESHOLD_MODE)')
+    parser.add_argument('--check', action='store_true',
+                        help='check the results instead of timing, see above')
+    parser.add_argument('--check-clip', default='cuts/cut.mp4',
+                        help='clip of the checks, its first --max-frames frames are used')
+    args = parser.parse_args(argv)
+    if args.threshold_mode is not None:
+        config.THRESHOLD_MODE = args.threshold_mode
+
+    camera = Camera([720, 1280, 3], 'camera_cal/calibration*.jpg',
+                    9, 6, 'camera_calibration')
+
+    with ImageDirectorySource(args.images) as source:
+        images = list(source)
+    if args.check:
+        with VideoCaptureSource(args.check_clip) as source:
+            frames = [frame for _, frame in zip(range(args.max_frames), source)]
+        return 0 if run_checks(camera, images, frames) else 1
+
+    timings = {}
+    if images:
+        timings.update(('stage/' + name, latencies) for name, latencies in
+                       benchmark_stages(camera, images, args.warmup, args.repeats).items())
+
+    for file_name in sorted(glob.glob(args.clips)):
+        with VideoCaptureSource(file_name) as source:
+            frames = [frame for _, frame in zip(range(args.max_frames), source)]
+        timings['clip/' + file_name] = benchmark_clip(camera, frames, args.warmup, args.repeats)
+
+    results = {name: statistics(latencies) for name, latencies in timings.items()}
+
+    print('{0:<40} {1:>8} {2:>8} {3:>8} {4:>8}'.format('Benchmark', 'fps', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name, stats in results.items():
+        print('{0:<40} {1:8.1f} {2:8.2f} {3:8.2f} {4:8.2f}'.format(
+            name, stats['fps'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms']))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': {'python': platform.python_version(),
+                                       'numpy': np.__version__,
+                                       'opencv': cv2.__version__,
+                                       'machine': platform.machine()},
+                       'threshold_mode': config.THRESHOLD_MODE,
+                       'results': results}, f, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('threshold_mode', config.THRESHOLD_MODE) != config.THRESHOLD_MODE:
+            print('Warning: the baseline was measured in the {0} threshold mode'.format(
+                baseline['threshold_mode']))
+        baseline = baseline['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for name in regressions:
+            print('Regression: {0} {1:.1f} fps, baseline {2:.1f} fps'.format(
+                name, results[name]['fps'], baseline[name]['fps']))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+"""
+On-disk store of camera calibrations
+
+Every calibration lives in its own directory, keyed by the camera id, the
+image resolution and a hash of everything it was calculated from, including
+the perspective transform composed into the maps:
+
+    <store_dir>/<camera_id>/<width>x<height>_<key>/header.json
+    <store_dir>/<camera_id>/<width>x<height>_<key>/<array name>.npy
+
+The arrays are plain .npy files, loaded memory-mapped. Characters of the
+camera id that are not safe in a file name are replaced.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+# Changing the stored arrays or how they are calculated invalidates
+# every stored calibration
+FORMAT_VERSION = 2
+
+
+def calibration_key(image_shape, image_hashes, nx_chessboard, ny_chessboard, warp_matrix,
+                    map_type):
+    # image_hashes are the hashes of the calibration images, warp_matrix and
+    # map_type those of the stored undistort + warp maps
+    key = hashlib.sha1()
+    key.update(json.dumps([FORMAT_VERSION, list(image_shape[0:2]), nx_chessboard,
+                           ny_chessboard, np.asarray(warp_matrix, np.float64).tolist(),
+                           int(map_type), list(image_hashes)]).encode())
+    return key.hexdigest()
+
+
+def camera_dir_name(camera_id):
+    # camera_id as a single path component, ids that had to be changed get
+    # a hash of the original, so they stay distinct
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', camera_id).lstrip('.')
+    if name != camera_id or not name:
+        name += '_' + hashlib.sha1(camera_id.encode()).hexdigest()[:8]
+    return name
+
+
+def calibration_dir(store_dir, camera_id, image_shape, key):
+    return os.path.join(store_dir, camera_dir_name(camera_id),
+                        '{0}x{1}_{2}'.format(image_shape[1], image_shape[0], key[:16]))
+
+
+def load_calibration(store_dir, camera_id, image_shape, key):
+    # Returns (header, arrays) or None if there is no matching calibration
+    directory = calibration_dir(store_dir, camera_id, image_shape, key)
+    try:
+        with open(os.path.join(directory, 'header.json')) as f:
+            header = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if (header.get('version') != FORMAT_VERSION or header.get('key') != key or
+            header.get('image_shape') != list(image_shape[0:2])):
+        return None
+
+    arrays = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+              for name in header['arrays']}
+    return header, arrays
+
+
+def save_calibration(store_dir, camera_id, image_shape, key, arrays, extra_header=None):
+    directory = calibration_dir(store_dir, camera_id, image_shape, key)
+    parent = os.path.dirname(directory)
+    os.makedirs(parent, exist_ok=True)
+
+    header = dict(extra_header or {})
+    header.update({'version': FORMAT_VERSION, 'key': key, 'camera_id': camera_id,
+                   'image_shape': list(image_shape[0:2]), 'arrays': sorted(arrays)})
+
+    # Written into a temporary directory and renamed, so readers never see
+    # a partially written calibration
+    temp_directory = tempfile.mkdtemp(dir=parent)
+    for name, array in arrays.items():
+        np.save(os.path.join(temp_directory, name + '.npy'), np.ascontiguousarray(array))
+    with open(os.path.join(temp_directory, 'header.json'), 'w') as f:
+        json.dump(header, f, indent=1)
+    try:
+        os.rename(temp_directory, directory)
+    except OSError:
+        # Stored by someone else in the meantime
+        shutil.rmtree(temp_directory)
@@ -1,10 +1,14 @@
+import contextlib
 import os
 import glob
-import pickle
+import hashlib
+import multiprocessing
 
 import cv2
 import numpy as np
 
+import calibration_store
+
 
 def generate_grid(nx, ny):
     grid = np.zeros((ny * nx, 3), np.float32)
@@ -14,7 +18,63 @@ def generate_grid(nx, ny):
     return grid
 
 
-def calculate_object_and_image_points(chessboard_images_filename_pattern, nx, ny):
+def file_hash(file_name, chunk_size=1024 * 1024):
+    # Read in chunks, the files can be videos of many gigabytes
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+# Chessboards are searched on images downscaled to this width,
+# the corners are refined on the full resolution image
+CHESSBOARD_DETECTION_WIDTH = 640
+# Part of the file names of the cached corners, with the width. Changing
+# the search or the refinement must change it.
+CHESSBOARD_DETECTION_VERSION = 2
+
+def find_chessboard_corners(fname, nx, ny):
+    img = cv2.imread(fname)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    scale = min(1.0, CHESSBOARD_DETECTION_WIDTH / gray.shape[1])
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    flags = cv2.CALIB_CB_ADAPTIVE_THRESH | cv2.CALIB_CB_NORMALIZE_IMAGE | cv2.CALIB_CB_FAST_CHECK
+    ret, corners = cv2.findChessboardCorners(small, (nx, ny), flags=flags)
+    if ret:
+        corners = corners / scale
+        # Search window of the refinement in full resolution pixels
+        window = max(int(round(1 / scale)) * 2 + 1, 5)
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+        corners = cv2.cornerSubPix(gray, corners.astype(np.float32), (window, window), (-1, -1), criteria)
+    else:
+        # Fall back to the full resolution search
+        ret, corners = cv2.findChessboardCorners(gray, (nx, ny), None)
+
+    return corners if ret else None
+
+
+def _find_chessboard_corners_star(args):
+    return find_chessboard_corners(*args)
+
+
+def load_cached_corners(cache_file_name):
+    # Returns (found, corners), an empty array marks a failed image
+    if not os.path.isfile(cache_file_name):
+        return False, None
+    corners = np.load(cache_file_name)
+    return True, (corners if corners.size > 0 else None)
+
+
+def save_cached_corners(cache_file_name, corners):
+    if corners is None:
+        corners = np.zeros((0, 1, 2), np.float32)
+    np.save(cache_file_name, corners)
+
+
+def calculate_object_and_image_points(chessboard_images_filename_pattern, nx, ny,
+                                      corners_cache_dir=None, processes=None):
     objp = generate_grid(nx, ny)
 
     # Arrays to store object points and image points from all the images.
@@ -22,27 +82,48 @@ def calculate_object_and_image_points(chessboard_images_filename_pattern, nx, ny
     imgpoints = []  # 2d points in image plane.
 
     # Make a list of calibration images
-    images = glob.glob(chessboard_images_filename_pattern)
+    images = sorted(glob.glob(chessboard_images_filename_pattern))
 
-    # Step through the list and search for chessboard corners
+    # Corners found earlier are cached by the hash of the image file
+    all_corners = [None] * len(images)
+    cache_file_names = [None] * len(images)
+    missing = []
     for idx, fname in enumerate(images):
-        print(
-            "Finding chessboard patterns {0}/{1}".format(idx + 1, len(images)), end='\r')
-        img = cv2.imread(fname)
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if corners_cache_dir is not None:
+            cache_file_name = '{0}_{1}x{2}_w{3}_v{4}.npy'.format(
+                file_hash(fname), nx, ny, CHESSBOARD_DETECTION_WIDTH,
+                CHESSBOARD_DETECTION_VERSION)
+            cache_file_names[idx] = os.path.join(corners_cache_dir, cache_file_name)
+            found, all_corners[idx] = load_cached_corners(cache_file_names[idx])
+            if found:
+                continue
+        missing.append(idx)
 
-        # Find the chessboard corners
-        ret, corners = cv2.findChessboardCorners(gray, (nx, ny), None)
+    # Search for chessboard corners in the rest of the images, in parallel
+    if missing:
+        args = [(images[idx], nx, ny) for idx in missing]
+        parallel = len(missing) > 1 and processes != 1
+        with (multiprocessing.Pool(processes) if parallel else contextlib.nullcontext()) as pool:
+            if parallel:
+                results = pool.imap(_find_chessboard_corners_star, args)
+            else:
+                results = map(_find_chessboard_corners_star, args)
+            for count, (idx, corners) in enumerate(zip(missing, results)):
+                print("Finding chessboard patterns {0}/{1}".format(count + 1, len(missing)), end='\r')
+                all_corners[idx] = corners
+                if corners_cache_dir is not None:
+                    os.makedirs(corners_cache_dir, exist_ok=True)
+                    save_cached_corners(cache_file_names[idx], corners)
+        print()
 
+    for fname, corners in zip(images, all_corners):
         # If found, add object points, image points
-        if ret == True:
+        if corners is not None:
             objpoints.append(objp)
             imgpoints.append(corners)
         else:
-            print()
             print('Failed: ' + fname)
 
-    print()
     return objpoints, imgpoints
 
 def calculate_camera_matrix_and_distortion(objpoints, imgpoints, target_image_shape):
@@ -68,41 +149,137 @@ def get_perspective_transform(img_shape):
 
     return cv2.getPerspectiveTransform(src, dst), src, dst
 
+# Fixed point maps, the fastest to remap with
+UNDISTORT_MAP_TYPE = cv2.CV_16SC2
+
+def get_undistort_maps(matrix, distortion, img_shape, warp_matrix=None):
+    img_size = (img_shape[1], img_shape[0])
+    # initUndistortRectifyMap maps every target pixel through inv(matrix * R),
+    # so R = inv(matrix) * warp_matrix * matrix composes the perspective warp
+    # after the undistortion.
+    if warp_matrix is None:
+        rectification = None
+    else:
+        rectification = np.linalg.inv(matrix).dot(warp_matrix).dot(matrix)
+    return cv2.initUndistortRectifyMap(
+        matrix, distortion, rectification, matrix, img_size, UNDISTORT_MAP_TYPE)
+
+def get_map_source_region(map1, img_shape):
+    # Bounding box (y_low, y_high, x_low, x_high) of the source pixels read
+    # by a fixed point map, everything outside of it is thrown away
+    x = map1[:, :, 0]
+    y = map1[:, :, 1]
+    inside = (x >= 0) & (x < img_shape[1]) & (y >= 0) & (y < img_shape[0])
+    # +1 for the neighbour used by the interpolation
+    return (int(y[inside].min()), min(int(y[inside].max()) + 2, img_shape[0]),
+            int(x[inside].min()), min(int(x[inside].max()) + 2, img_shape[1]))
+
 def warp(img, M):
     img_size = (img.shape[1], img.shape[0])
     return cv2.warpPerspective(img, M, img_size, flags=cv2.INTER_NEAREST)
 
 
+# remap handles at most this many channels in one image
+MAX_CHANNELS = 128
+
+def transform_batch(transform, imgs):
+    # Applies a per image OpenCV transform to a (N, H, W[, C]) batch, stacking
+    # the frames as channels of one image, so OpenCV makes a single pass
+    channels_per_frame = int(np.prod(imgs.shape[3:]))
+    chunk = max(MAX_CHANNELS // channels_per_frame, 1)
+    results = []
+    for i in range(0, imgs.shape[0], chunk):
+        frames = imgs[i:i + chunk]
+        stacked = np.ascontiguousarray(np.moveaxis(frames, 0, 2)).reshape(
+            frames.shape[1], frames.shape[2], -1)
+        result = transform(stacked)
+        result = result.reshape(result.shape[0:2] + (frames.shape[0],) + frames.shape[3:])
+        results.append(np.moveaxis(result, 2, 0))
+    return np.concatenate(results) if len(results) > 1 else results[0]
+
+
 class Camera:
-    def __init__(self, image_shape, calibration_images_pattern, nx_chessboard, ny_chessboard, camera_pickle_file_name):
-        if not os.path.isfile(camera_pickle_file_name):
+    def __init__(self, image_shape, calibration_images_pattern, nx_chessboard, ny_chessboard, calibration_store_dir,
+                 camera_id='default'):
+        # The stored maps are composed with the perspective transform, so it
+        # is part of the key: changing it recalculates them
+        perspective_matrix, src, dest = get_perspective_transform(image_shape)
+        image_hashes = [file_hash(file_name)
+                        for file_name in sorted(glob.glob(calibration_images_pattern))]
+        key = calibration_store.calibration_key(
+            image_shape, image_hashes, nx_chessboard, ny_chessboard, perspective_matrix,
+            UNDISTORT_MAP_TYPE)
+        stored = calibration_store.load_calibration(
+            calibration_store_dir, camera_id, image_shape, key)
+
+        if stored is None:
             objpoints, imgpoints = calculate_object_and_image_points(
-                calibration_images_pattern, nx_chessboard, ny_chessboard)
+                calibration_images_pattern, nx_chessboard, ny_chessboard,
+                os.path.join(calibration_store_dir, 'corners'))
             matrix, distortion = calculate_camera_matrix_and_distortion(
                 objpoints, imgpoints, image_shape)
-            pickle.dump((matrix, distortion), open(
-                camera_pickle_file_name, "wb"))
-        else:
-            print('Using pickled camera parameters.')
-            (matrix, distortion) = pickle.load(
-                open(camera_pickle_file_name, "rb"))
 
-        perspective_matrix, src, dest = get_perspective_transform(
-            image_shape)
+            # Fixed point maps, calculated once instead of on every frame
+            undistort_map1, undistort_map2 = get_undistort_maps(
+                matrix, distortion, image_shape)
+            undistort_warp_map1, undistort_warp_map2 = get_undistort_maps(
+                matrix, distortion, image_shape, perspective_matrix)
+            warp_source_region = get_map_source_region(undistort_warp_map1, image_shape)
+
+            arrays = {'matrix': matrix, 'distortion': distortion,
+                      'undistort_map1': undistort_map1, 'undistort_map2': undistort_map2,
+                      'undistort_warp_map1': undistort_warp_map1,
+                      'undistort_warp_map2': undistort_warp_map2}
+            calibration_store.save_calibration(
+                calibration_store_dir, camera_id, image_shape, key, arrays,
+                {'nx_chessboard': nx_chessboard, 'ny_chessboard': ny_chessboard,
+                 'warp_source_region': warp_source_region})
+        else:
+            print('Using stored camera calibration.')
+            header, arrays = stored
+            warp_source_region = tuple(header['warp_source_region'])
 
         self.image_shape = image_shape
-        self.matrix = matrix
-        self.distortion = distortion
+        self.calibration_key = key
+        self.matrix = np.array(arrays['matrix'])
+        self.distortion = np.array(arrays['distortion'])
         self.warp_matrix = perspective_matrix
         self.unwarp_matrix = cv2.invert(perspective_matrix)[1]
         self.warp_source_points = src
         self.warp_target_points = dest
 
-    def undistort(self, img):
-        return cv2.undistort(img, self.matrix, self.distortion, None, self.matrix)
+        self.undistort_map1 = arrays['undistort_map1']
+        self.undistort_map2 = arrays['undistort_map2']
+        self.undistort_warp_map1 = arrays['undistort_warp_map1']
+        self.undistort_warp_map2 = arrays['undistort_warp_map2']
+        self.warp_source_region = warp_source_region
+
+    def undistort(self, img, dst=None):
+        return cv2.remap(img, self.undistort_map1, self.undistort_map2, cv2.INTER_LINEAR, dst=dst)
+
+    def undistort_and_warp(self, img, interpolation=cv2.INTER_NEAREST, dst=None):
+        return cv2.remap(img, self.undistort_warp_map1, self.undistort_warp_map2, interpolation,
+                         dst=dst)
+
+    def warp(self, img, dst=None):
+        return cv2.warpPerspective(img, self.warp_matrix, (img.shape[1], img.shape[0]), dst=dst,
+                                   flags=cv2.INTER_NEAREST)
+
+    def undistort_batch(self, imgs):
+        return transform_batch(self.undistort, imgs)
+
+    def undistort_and_warp_batch(self, imgs, interpolation=cv2.INTER_NEAREST):
+        return transform_batch(
+            lambda img: self.undistort_and_warp(img, interpolation), imgs)
 
-    def warp(self, img):
-        return cv2.warpPerspective(img, self.warp_matrix, (img.shape[1], img.shape[0]), flags=cv2.INTER_NEAREST)
+    def warp_batch(self, imgs):
+        # One warpPerspective per frame: above 4 channels it rounds
+        # differently, so stacking the frames would not match warp
+        result = np.empty_like(imgs)
+        for img, dst in zip(imgs, result):
+            self.warp(img, dst)
+        return result
 
-    def unwarp(self, img):
-        return cv2.warpPerspective(img, self.unwarp_matrix, (img.shape[1], img.shape[0]), flags=cv2.INTER_NEAREST)
\ No newline at end of file
+    def unwarp(self, img, dst=None):
+        return cv2.warpPerspective(img, self.unwarp_matrix, (img.shape[1], img.shape[0]), dst=dst,
+                                   flags=cv2.INTER_NEAREST)
\ No newline at end of file
@@ -5,3 +5,38 @@ Config file
 VISUALIZE_THRESHOLD = False
 VISUALIZE_LANE_FINDING_HISTOGRAM = False
 VISUALIZE_LANE_FINDING = False
+
+# Order of thresholding and warping in the pipeline:
+# 'warped': undistort and warp the color frame with bilinear interpolation,
+#   then threshold the bird's-eye image. Closest to thresholding the
+#   undistorted frame and warping the binary image.
+# 'full': threshold the whole frame, then undistort and warp the binary image.
+#   The same as 'warped' with nearest neighbour interpolation, about 6 ms
+#   faster per frame, but it finds a few percent more lane pixels.
+# 'region': same as 'full', but only thresholds the region that is visible
+#   after warping
+THRESHOLD_MODE = 'warped'
+
+# Where thresholding stores its color lookup tables, None keeps them in memory
+# only and builds them again in every process. main.py sets it with
+# --threshold-tables.
+THRESHOLD_LOOKUP_TABLE_DIR = None
+
+# Live mode: end-to-end latency budget per frame in seconds. Over budget the
+# pipeline steps down to the fast path, it steps back up once the latency is
+# below LIVE_RECOVERY_FRACTION of the budget. The fast path thresholds in
+# FAST_THRESHOLD_MODE, skips the undistort (the lane is drawn on the
+# distorted frame) and keeps tracking the lane while it is valid.
+LIVE_LATENCY_BUDGET = 0.1
+LIVE_RECOVERY_FRACTION = 0.7
+FAST_THRESHOLD_MODE = 'region'
+
+# Codecs of the output videos, the first one OpenCV can write is used.
+# avc1 (H.264) plays in browsers, but not every OpenCV build can encode it;
+# mp4v (MPEG-4 Part 2) always works, with larger files at the same quality.
+VIDEO_FOURCCS = ('avc1', 'mp4v')
+
+# Directory of the decoded frame cache (frame_cache.py), None disables it
+FRAME_CACHE_DIR = None
+# The least recently used cache files are evicted above this size
+FRAME_CACHE_MAX_BYTES = 8 * 1024**3
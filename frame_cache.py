@@ -0,0 +1,222 @@
+"""
+Cache of decoded video frames and pipeline intermediates
+
+Rerunning the pipeline over the same recordings decodes them only once. The
+first run records the decoded frames, and the undistorted frames and warped
+binaries of prepare_frame, in raw array files:
+
+    <cache_dir>/<key>.<name>.raw
+
+Each file is a 4 KB JSON header (shape, dtype, fps, source hash) followed by
+the raw rows, and is read back memory-mapped. Decoded frames are keyed by a
+hash of the video file, intermediates also by the camera calibration and the
+thresholding. The least recently used files are evicted to stay under the
+size limit; a video whose files alone would not fit is not recorded.
+"""
+
+import hashlib
+import json
+import os
+
+import cv2
+import numpy as np
+
+import config
+import thresholding
+from camera import file_hash
+from frame_io import FrameSource, VideoCaptureSource
+from pipeline import prepare_frames, read_frames
+from profiling import NULL_PROFILER
+
+# Changing the files or how the intermediates are calculated invalidates
+# every cached file
+FORMAT_VERSION = 1
+HEADER_SIZE = 4096
+MAGIC = b'LANECACHE'
+
+
+def read_raw_array(file_name):
+    # Returns (header, memory-mapped array)
+    with open(file_name, 'rb') as f:
+        data = f.read(HEADER_SIZE)
+    if not data.startswith(MAGIC):
+        raise IOError('Not a cache file: ' + file_name)
+    header = json.loads(data[len(MAGIC):].rstrip(b'\0').decode())
+    array = np.memmap(file_name, np.dtype(header['dtype']), 'r', offset=HEADER_SIZE,
+                      shape=tuple(header['shape']))
+    return header, array
+
+
+class RawArrayWriter:
+    # Appends rows to a temporary file, renamed to file_name by commit
+    def __init__(self, file_name, header):
+        self.file_name = file_name
+        self.temp_file_name = file_name + '.part'
+        self.header = dict(header)
+        self.row_shape = None
+        self.dtype = None
+        self.rows = 0
+        self.file = open(self.temp_file_name, 'wb')
+        self.file.write(b'\0' * HEADER_SIZE)
+
+    def append(self, row):
+        row = np.ascontiguousarray(row)
+        if self.row_shape is None:
+            self.row_shape = row.shape
+            self.dtype = row.dtype
+        self.file.write(row.data)
+        self.rows += 1
+
+    def extend(self, rows):
+        # Appends the rows of an array at once
+        rows = np.ascontiguousarray(rows)
+        if self.row_shape is None:
+            self.row_shape = rows.shape[1:]
+            self.dtype = rows.dtype
+        self.file.write(rows.data)
+        self.rows += len(rows)
+
+    def commit(self):
+        self.header['shape'] = [self.rows] + list(self.row_shape or [])
+        self.header['dtype'] = (self.dtype or np.dtype(np.uint8)).str
+        data = MAGIC + json.dumps(self.header).encode()
+        if len(data) > HEADER_SIZE:
+            raise ValueError('Cache header too large')
+        self.file.seek(0)
+        self.file.write(data)
+        self.file.close()
+        os.replace(self.temp_file_name, self.file_name)
+
+    def abort(self):
+        if not self.file.closed:
+            self.file.close()
+        if os.path.exists(self.temp_file_name):
+            os.remove(self.temp_file_name)
+
+
+class FrameCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def file_name(self, key, name):
+        return os.path.join(self.cache_dir, '{0}.{1}.raw'.format(key[:16], name))
+
+    def load(self, key, name):
+        # Returns (header, array) or None, and marks the file as recently used
+        file_name = self.file_name(key, name)
+        if not os.path.exists(file_name):
+            return None
+        os.utime(file_name)
+        return read_raw_array(file_name)
+
+    def writer(self, key, name, header):
+        return RawArrayWriter(self.file_name(key, name), header)
+
+    def evict(self, keep=()):
+        # Removes the least recently used files until the cache fits in
+        # max_bytes, except the files in keep
+        files = [os.path.join(self.cache_dir, file_name)
+                 for file_name in os.listdir(self.cache_dir) if file_name.endswith('.raw')]
+        files = [file_name for file_name in files if file_name not in keep]
+        files.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(file_name) for file_name in files)
+        for file_name in files:
+            if total <= self.max_bytes:
+                break
+            total -= os.path.getsize(file_name)
+            os.remove(file_name)
+
+
+def prepared_key(source_hash, camera):
+    key = hashlib.sha1()
+    key.update(json.dumps([FORMAT_VERSION, source_hash, camera.calibration_key,
+                           config.THRESHOLD_MODE, thresholding.LOOKUP_TABLE_VERSION,
+                           list(thresholding.DEFAULT_THRESHOLD_PARAMS)]).encode())
+    return key.hexdigest()
+
+
+class CachedVideo(FrameSource):
+    # A video file through a FrameCache. Iterating yields the decoded frames,
+    # memory-mapped if cached, otherwise decoded and recorded; only a complete
+    # pass is kept.
+    def __init__(self, file_name, cache):
+        self.file_name = file_name
+        self.cache = cache
+        self.source_hash = file_hash(file_name)
+        self.writers = []
+
+        cached = cache.load(self.source_hash, 'frames')
+        if cached is not None:
+            header, self.frames = cached
+            self.fps = header['fps']
+            self.frame_size = (self.frames.shape[2], self.frames.shape[1])
+            self.frame_count = len(self.frames)
+            self.source = None
+        else:
+            self.frames = None
+            self.source = VideoCaptureSource(file_name)
+            self.fps = self.source.fps
+            self.frame_size = self.source.frame_size
+            self.frame_count = int(self.source.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    def header(self):
+        return {'version': FORMAT_VERSION, 'source': os.path.basename(self.file_name),
+                'source_hash': self.source_hash, 'fps': self.fps}
+
+    def __iter__(self):
+        if self.frames is not None:
+            return iter(self.frames)
+        return self.record(self.source, self.source_hash, ['frames'], 3)
+
+    def record(self, rows, key, names, bytes_per_pixel):
+        # Yields the rows (or tuples of rows, one per name) and writes them to
+        # the cache, committing once all were read. Rows that would not fit in
+        # the cache, at bytes_per_pixel of all names, are only passed through.
+        (width, height) = self.frame_size
+        if self.frame_count * width * height * bytes_per_pixel > self.cache.max_bytes:
+            yield from rows
+            return
+        writers = [self.cache.writer(key, name, self.header()) for name in names]
+        self.writers.extend(writers)
+        for row in rows:
+            if len(writers) == 1:
+                writers[0].append(row)
+            else:
+                for writer, part in zip(writers, row):
+                    writer.append(part)
+            yield row
+        for writer in writers:
+            writer.commit()
+            self.writers.remove(writer)
+        self.cache.evict([writer.file_name for writer in writers])
+
+    def prepared_frames(self, camera, workers=1, queue_depth=None, profiler=NULL_PROFILER,
+                        context=None):
+        # Like pipeline.prepare_frames over the frames of the video, reading
+        # the intermediates from the cache when they are there
+        key = prepared_key(self.source_hash, camera)
+        undistorted = self.cache.load(key, 'undistorted')
+        binaries = self.cache.load(key, 'binary_warped')
+        if undistorted is not None and binaries is not None:
+            return zip(read_frames(undistorted[1], profiler), binaries[1])
+        prepared = prepare_frames(read_frames(self, profiler), camera, workers, queue_depth,
+                                  profiler, context)
+        return self.record(prepared, key, ['undistorted', 'binary_warped'], 3 + 1)
+
+    def close(self):
+        for writer in self.writers:
+            writer.abort()
+        self.writers = []
+        if self.source is not None:
+            self.source.close()
+
+
+def get_frame_cache(cache_dir=None):
+    # The cache in cache_dir or config.FRAME_CACHE_DIR, None if not set
+    if cache_dir is None:
+        cache_dir = config.FRAME_CACHE_DIR
+    if cache_dir is None:
+        return None
+    return FrameCache(cache_dir, config.FRAME_CACHE_MAX_BYTES)
@@ -0,0 +1,170 @@
+"""
+Frame sources and sinks for the video pipeline
+
+Sources are iterables of RGB uint8 frames with an fps attribute, sinks have
+a write(frame) method. Both are context managers.
+"""
+
+import glob
+
+import cv2
+import numpy as np
+
+import config
+
+
+class FrameSource:
+    fps = 25.0
+
+    def __iter__(self):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FrameSink:
+    def write(self, frame):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class VideoCaptureSource(FrameSource):
+    # A video file, a camera device number or a stream URL
+    def __init__(self, file_name_or_device):
+        self.capture = cv2.VideoCapture(file_name_or_device)
+        if not self.capture.isOpened():
+            raise IOError('Cannot open video: {0}'.format(file_name_or_device))
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or FrameSource.fps
+        self.frame_size = (int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                           int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+    def __iter__(self):
+        while True:
+            ret, frame = self.capture.read()
+            if not ret:
+                return
+            yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+    def close(self):
+        self.capture.release()
+
+
+class ImageDirectorySource(FrameSource):
+    def __init__(self, file_name_pattern, fps=FrameSource.fps):
+        self.file_names = sorted(glob.glob(file_name_pattern))
+        self.fps = fps
+
+    def __iter__(self):
+        for file_name in self.file_names:
+            yield cv2.cvtColor(cv2.imread(file_name), cv2.COLOR_BGR2RGB)
+
+
+class RawFrameSource(FrameSource):
+    # Frames stored back to back as raw RGB bytes, read without copying
+    def __init__(self, file_name, frame_shape, fps=FrameSource.fps):
+        self.frames = np.memmap(file_name, np.uint8, 'r').reshape(
+            (-1,) + tuple(frame_shape))
+        self.fps = fps
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    def close(self):
+        del self.frames
+
+
+class VideoFileSink(FrameSink):
+    # fourcc is a codec or a list of codecs tried in order, by default
+    # config.VIDEO_FOURCCS. The fourcc attribute is the one used.
+    def __init__(self, file_name, fps, frame_size, fourcc=None):
+        if fourcc is None:
+            fourcc = config.VIDEO_FOURCCS
+        if isinstance(fourcc, str):
+            fourcc = [fourcc]
+        for code in fourcc:
+            self.writer = cv2.VideoWriter(
+                file_name, cv2.VideoWriter_fourcc(*code), fps, tuple(frame_size))
+            if self.writer.isOpened():
+                self.fourcc = code
+                return
+        raise IOError('Cannot open video for writing: {0} ({1})'.format(
+            file_name, ', '.join(fourcc)))
+
+    def write(self, frame):
+        self.writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+
+    def close(self):
+        self.writer.release()
+
+
+class ImageDirectorySink(FrameSink):
+    # file_name_pattern is formatted with the frame number, e.g. 'out/{0:05d}.jpg'
+    def __init__(self, file_name_pattern):
+        self.file_name_pattern = file_name_pattern
+        self.frame_count = 0
+
+    def write(self, frame):
+        cv2.imwrite(self.file_name_pattern.format(self.frame_count),
+                    cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+        self.frame_count += 1
+
+
+class RawFrameSink(FrameSink):
+    def __init__(self, file_name):
+        self.file = open(file_name, 'wb')
+
+    def write(self, frame):
+        self.file.write(np.ascontiguousarray(frame, np.uint8).data)
+
+    def close(self):
+        self.file.close()
+
+
+class NullSink(FrameSink):
+    # Drops the frames, for measuring the pipeline without encoding
+    def __init__(self):
+        self.frame_count = 0
+
+    def write(self, frame):
+        self.frame_count += 1
+
+
+class WindowSink(FrameSink):
+    # Shows the frames in a window, for watching live mode
+    def __init__(self, window_name='Lanes'):
+        self.window_name = window_name
+
+    def write(self, frame):
+        cv2.imshow(self.window_name, cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+        cv2.waitKey(1)
+
+    def close(self):
+        cv2.destroyWindow(self.window_name)
+
+
+def batches(frames, batch_size):
+    # Groups the frames of a source into (N, H, W, 3) arrays of at most
+    # batch_size frames
+    batch = []
+    for frame in frames:
+        batch.append(frame)
+        if len(batch) == batch_size:
+            yield np.stack(batch)
+            batch = []
+    if batch:
+        yield np.stack(batch)
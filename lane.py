@@ -1,38 +1,74 @@
+from collections import namedtuple
+
 import numpy as np
 
-def is_sane(left_plot_x, right_plot_x):
+# Allowed distances in pixels between the lines, at the first and the last plot point
+SanityLimits = namedtuple(
+    'SanityLimits', ['lower_min', 'lower_max', 'upper_min', 'upper_max'])
+
+DEFAULT_SANITY_LIMITS = SanityLimits(lower_min=290, lower_max=800, upper_min=490, upper_max=700)
+
+def is_sane(left_plot_x, right_plot_x, limits=DEFAULT_SANITY_LIMITS):
+    # The plot points are along the first axis, any further axes are
+    # checked element-wise, e.g. (points, streams)
     d_lower = right_plot_x[0] - left_plot_x[0]
     d_upper = right_plot_x[-1] - left_plot_x[-1]
-    return d_lower >= 290 and d_lower <= 800 and d_upper >= 490 and d_upper <= 700
+    return ((d_lower >= limits.lower_min) & (d_lower <= limits.lower_max) &
+            (d_upper >= limits.upper_min) & (d_upper <= limits.upper_max))
 
 
 ym_per_pix = 30/720.0 # meters per pixel in y dimension
 xm_per_pix = 3.7/700.0 # meters per pixel in x dimension
 
-def find_curvature(leftx, rightx, ploty):  
-    # Evaluation point  
-    y_eval = np.max(ploty)
-
-    # Fit new polynomials to x,y in world space
-    left_fit_cr = np.polyfit(ploty*ym_per_pix, leftx*xm_per_pix, 2)
-    right_fit_cr = np.polyfit(ploty*ym_per_pix, rightx*xm_per_pix, 2)
-
-    # Calculate the new radii of curvature
-    left_curverad = ((1 + (2*left_fit_cr[0]*y_eval*ym_per_pix + left_fit_cr[1])**2)**1.5) / np.absolute(2*left_fit_cr[0])
-    right_curverad = ((1 + (2*right_fit_cr[0]*y_eval*ym_per_pix + right_fit_cr[1])**2)**1.5) / np.absolute(2*right_fit_cr[0])
-
-    return (left_curverad + right_curverad) / 2
+def to_world_polynomials(polys):
+    # Pixel space x = a*y^2 + b*y + c to meters, the last axis of polys is
+    # [a, b, c]. The scaling is linear, so this is exactly the least squares
+    # fit of the scaled points.
+    scale = np.array([xm_per_pix / ym_per_pix**2, xm_per_pix / ym_per_pix, xm_per_pix])
+    return np.asarray(polys, np.float64) * scale
+
+def find_curvature_radius(polys, y_eval):
+    # Radius of curvature in meters at y_eval (pixels), for polys of any
+    # shape (..., 3), e.g. both lines of a batch of frames
+    world_polys = to_world_polynomials(polys)
+    a = world_polys[..., 0]
+    b = world_polys[..., 1]
+    return ((1 + (2*a*y_eval*ym_per_pix + b)**2)**1.5) / np.absolute(2*a)
+
+def find_curvature(left_poly, right_poly, y_eval):
+    # Mean radius of curvature of the two lines, vectorized over the
+    # leading axes of the polynomials
+    return (find_curvature_radius(left_poly, y_eval) + find_curvature_radius(right_poly, y_eval)) / 2
+
+def find_lane_center(left_poly, right_poly, y_eval):
+    # Lane center in pixels at y_eval, vectorized like find_curvature
+    left_poly = np.asarray(left_poly, np.float64)
+    right_poly = np.asarray(right_poly, np.float64)
+    left_x = (left_poly[..., 0] * y_eval + left_poly[..., 1]) * y_eval + left_poly[..., 2]
+    right_x = (right_poly[..., 0] * y_eval + right_poly[..., 1]) * y_eval + right_poly[..., 2]
+    return (left_x + right_x) / 2.0
 
 def find_relative_car_position(lane_center, image_center):
     return (image_center - lane_center) * xm_per_pix
 
 class Lane:
     MAX_AGE = 50
+    # Weight of the pixel history kept per frame
+    FORGETTING_FACTOR = 0.8
+    # Consecutive failed frames after which the lane is searched from scratch
+    MAX_TRACKING_FAILURES = 5
     TEXT_CHANGE_AFTER_FRAMES = 10
 
-    def __init__(self, image_shape):
+    def __init__(self, image_shape, frame_period=None, sanity_limits=DEFAULT_SANITY_LIMITS):
+        # age counts frames since the last sane one. With a frame_period (in
+        # seconds) and timestamps passed to set_time it counts frame periods,
+        # so frames that were dropped and never processed age the lane too.
         self.age = Lane.MAX_AGE
         self.frame = 0
+        self.frame_period = frame_period
+        self.sanity_limits = sanity_limits
+        self.time = None
+        self.last_sane_time = None
 
         self.image_shape = image_shape
         self.image_center_x = image_shape[1] / 2.0
@@ -40,6 +76,11 @@ class Lane:
         self.points = None
         self.left_poly = None
         self.right_poly = None
+
+        # Least squares sums of the pixels of the sane frames, older frames
+        # are weighted down by FORGETTING_FACTOR per frame
+        self.left_moments = None
+        self.right_moments = None
         
         self.center_x = None
         self.radius_of_curvature_m = None # meters
@@ -54,33 +95,71 @@ class Lane:
     def is_valid(self):
         return self.age < Lane.MAX_AGE
 
-    def update(self, left_plot_x, right_plot_x, plot_y, left_poly, right_poly):
-        if is_sane(left_plot_x, right_plot_x):
-            points_left = np.array([np.transpose(np.vstack([left_plot_x, plot_y]))])
-            points_right = np.array([np.flipud(np.transpose(np.vstack([right_plot_x, plot_y])))])
-            points = np.hstack((points_left, points_right))
-
-            if self.is_valid():
-                a = 0.8 ** self.age
-                self.points = a * self.points + (1-a) * points
-                self.left_poly = a * self.left_poly + (1-a) * left_poly
-                self.right_poly = a * self.right_poly + (1-a) * right_poly
+    def is_trackable(self):
+        return self.is_valid() and self.age <= Lane.MAX_TRACKING_FAILURES
+
+    def set_time(self, timestamp):
+        # Called with the timestamp of a frame before it is processed
+        self.time = timestamp
+        if self.frame_period is not None and self.last_sane_time is not None:
+            frames = (timestamp - self.last_sane_time) / self.frame_period
+            self.age = min(max(frames, 1), Lane.MAX_AGE)
+
+    def update(self, left_plot_x, right_plot_x, plot_y, left_poly, right_poly,
+               left_moments=None, right_moments=None):
+        # With the PolyMoments of the frame's pixels the smoothed polynomials
+        # are refitted from the weighted pixel history, otherwise the
+        # polynomials are blended
+        if is_sane(left_plot_x, right_plot_x, self.sanity_limits):
+            if left_moments is not None and right_moments is not None:
+                self.update_moments(left_moments, right_moments)
+                smoothed_left_x = np.polyval(self.left_poly, plot_y)
+                smoothed_right_x = np.polyval(self.right_poly, plot_y)
+                points_left = np.array([np.transpose(np.vstack([smoothed_left_x, plot_y]))])
+                points_right = np.array([np.flipud(np.transpose(np.vstack([smoothed_right_x, plot_y])))])
+                self.points = np.hstack((points_left, points_right))
             else:
-                self.points = points
-                self.left_poly = left_poly
-                self.right_poly = right_poly
-
-            self.radius_of_curvature_m = find_curvature(left_plot_x, right_plot_x, plot_y)
-            self.center_x = (left_plot_x[-1] + right_plot_x[-1]) / 2.0
+                points_left = np.array([np.transpose(np.vstack([left_plot_x, plot_y]))])
+                points_right = np.array([np.flipud(np.transpose(np.vstack([right_plot_x, plot_y])))])
+                points = np.hstack((points_left, points_right))
+
+                if self.is_valid():
+                    a = 0.8 ** self.age
+                    self.points = a * self.points + (1-a) * points
+                    self.left_poly = a * self.left_poly + (1-a) * left_poly
+                    self.right_poly = a * self.right_poly + (1-a) * right_poly
+                else:
+                    self.points = points
+                    self.left_poly = left_poly
+                    self.right_poly = right_poly
+
+            # Curvature and position of this frame, from its polynomials
+            y_eval = np.max(plot_y)
+            self.radius_of_curvature_m = find_curvature(left_poly, right_poly, y_eval)
+            self.center_x = find_lane_center(left_poly, right_poly, y_eval)
             self.relative_car_position_m = find_relative_car_position(self.center_x, self.image_center_x)
             if self.frame == 0:
                 self.radius_of_curvature_for_display_m = self.radius_of_curvature_m
                 self.relative_car_position_for_display_m = self.relative_car_position_m
             self.frame = (self.frame + 1) % Lane.TEXT_CHANGE_AFTER_FRAMES
             self.age = 1
+            self.last_sane_time = self.time
         else:
             self.update_insane()
 
+    def update_moments(self, left_moments, right_moments):
+        if self.is_valid() and self.left_moments is not None:
+            factor = Lane.FORGETTING_FACTOR ** self.age
+            self.left_moments.decay(factor)
+            self.right_moments.decay(factor)
+            self.left_moments.add(left_moments)
+            self.right_moments.add(right_moments)
+        else:
+            self.left_moments = left_moments.copy()
+            self.right_moments = right_moments.copy()
+        self.left_poly = self.left_moments.solve()
+        self.right_poly = self.right_moments.solve()
+
     def update_insane(self):
         # The min() is just to avoid overflow
         self.age = min(self.age + 1, Lane.MAX_AGE)
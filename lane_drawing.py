@@ -1,31 +1,111 @@
 import cv2
 import numpy as np
 
-def draw_lane(undist_img, pts, camera):
-    # Create an image to draw the lines on
-    warp_zero = np.zeros(undist_img.shape[0:2], np.uint8)
-    color_warp = np.dstack((warp_zero, warp_zero, warp_zero))
-
-    # Draw the lane onto the warped blank image
-    cv2.fillPoly(color_warp, np.int_([pts]), (0, 255, 0))
-
-    # Warp the blank back to original image space
-    newwarp = camera.unwarp(color_warp)
-
-    # Combine the result with the original image
-    result = cv2.addWeighted(undist_img, 1, newwarp, 0.3, 0)
-    return result
-
-def draw_all(undist_img, lane, camera):
-    if not lane.is_valid():
-        return undist_img
-
-    img = draw_lane(undist_img, lane.points, camera)
-    curvature = lane.radius_of_curvature_for_display_m
-    diff_m = lane.relative_car_position_for_display_m
-
-    color = (255, 255, 255) # if lane.is_up_to_date() else (255, 0, 0)
-    font = cv2.FONT_HERSHEY_SIMPLEX
-    cv2.putText(img, "Radius: {0:5.0f}m, Position: {1:0.2f}m".format(curvature, diff_m),
-                (10, 70), font, 2, color, 2, cv2.LINE_AA)
-    return img
+def draw_all(undist_img, lane, camera, renderer=None, dst=None):
+    if renderer is None:
+        renderer = LaneRenderer()
+    return renderer.draw_all(undist_img, lane, camera, dst)
+
+
+class LaneRenderer:
+    # Draws the lane area and the curvature text, keeping the overlay and
+    # the text between the frames of a video
+    POINTS_TOLERANCE = 0.5 # pixels
+    TEXT_POSITION = (10, 70)
+    FONT = cv2.FONT_HERSHEY_SIMPLEX
+    FONT_SCALE = 2
+    FONT_THICKNESS = 2
+
+    def __init__(self):
+        self.points = None
+        self.overlay_box = None # (x, y, width, height) in the image
+        self.overlay = None
+
+        self.text = None
+        self.text_box = None
+        self.text_sprite = None
+        self.text_alpha = None
+        self.text_background_alpha = None
+
+    def update_overlay(self, pts, camera, image_shape):
+        if (self.points is not None and self.points.shape == pts.shape and
+                np.max(np.abs(self.points - pts)) <= LaneRenderer.POINTS_TOLERANCE):
+            return
+        self.points = np.array(pts, np.float64)
+
+        # The polygon in image space: a perspective transform keeps lines
+        # straight, so transforming the corners transforms the polygon
+        image_pts = cv2.perspectiveTransform(
+            np.float32(pts).reshape(1, -1, 2), camera.unwarp_matrix).reshape(-1, 2)
+        image_pts = np.int32(np.round(image_pts))
+        (x, y, width, height) = cv2.boundingRect(image_pts)
+        x_low = min(max(x, 0), image_shape[1])
+        y_low = min(max(y, 0), image_shape[0])
+        x_high = min(max(x + width, x_low), image_shape[1])
+        y_high = min(max(y + height, y_low), image_shape[0])
+        self.overlay_box = (x_low, y_low, x_high - x_low, y_high - y_low)
+
+        # The overlay buffer is reused while it is large enough
+        if (self.overlay is None or self.overlay.shape[0] < y_high - y_low or
+                self.overlay.shape[1] < x_high - x_low):
+            self.overlay = np.zeros((image_shape[0], image_shape[1], 3), np.uint8)
+        overlay = self.overlay[0:y_high - y_low, 0:x_high - x_low]
+        overlay[:] = 0
+        cv2.fillPoly(overlay, [image_pts - (x_low, y_low)], (0, 255, 0))
+
+    def draw_lane(self, img, pts, camera):
+        # Blends the lane into img in place, only inside its bounding box
+        self.update_overlay(pts, camera, img.shape)
+        (x, y, width, height) = self.overlay_box
+        if width == 0 or height == 0:
+            return img
+        roi = img[y:y + height, x:x + width]
+        cv2.addWeighted(roi, 1, self.overlay[0:height, 0:width], 0.3, 0, dst=roi)
+        return img
+
+    def update_text(self, text, color, image_shape):
+        if text == self.text:
+            return
+        self.text = text
+
+        # Render the text once into a sprite and an alpha mask
+        ((width, height), baseline) = cv2.getTextSize(
+            text, LaneRenderer.FONT, LaneRenderer.FONT_SCALE, LaneRenderer.FONT_THICKNESS)
+        (x, y) = LaneRenderer.TEXT_POSITION
+        border = LaneRenderer.FONT_THICKNESS
+        x_low = max(x - border, 0)
+        y_low = max(y - height - border, 0)
+        x_high = min(x + width + border, image_shape[1])
+        y_high = min(y + baseline + border, image_shape[0])
+        self.text_box = (x_low, y_low, x_high - x_low, y_high - y_low)
+
+        mask = np.zeros((y_high - y_low, x_high - x_low), np.uint8)
+        cv2.putText(mask, text, (x - x_low, y - y_low), LaneRenderer.FONT,
+                    LaneRenderer.FONT_SCALE, 255, LaneRenderer.FONT_THICKNESS, cv2.LINE_AA)
+        self.text_alpha = mask.astype(np.float32) / 255
+        self.text_background_alpha = 1 - self.text_alpha
+        self.text_sprite = np.empty((mask.shape[0], mask.shape[1], 3), np.uint8)
+        self.text_sprite[:] = color
+
+    def draw_text(self, img, text, color):
+        self.update_text(text, color, img.shape)
+        (x, y, width, height) = self.text_box
+        roi = img[y:y + height, x:x + width]
+        cv2.blendLinear(roi, self.text_sprite, self.text_background_alpha, self.text_alpha,
+                        dst=roi)
+        return img
+
+    def draw_all(self, undist_img, lane, camera, dst=None):
+        if dst is None:
+            dst = np.empty_like(undist_img)
+        np.copyto(dst, undist_img)
+        if not lane.is_valid():
+            return dst
+
+        img = self.draw_lane(dst, lane.points, camera)
+        curvature = lane.radius_of_curvature_for_display_m
+        diff_m = lane.relative_car_position_for_display_m
+
+        color = (255, 255, 255) # if lane.is_up_to_date() else (255, 0, 0)
+        self.draw_text(img, "Radius: {0:5.0f}m, Position: {1:0.2f}m".format(curvature, diff_m), color)
+        return img
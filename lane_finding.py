@@ -3,39 +3,109 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 import config
-
-def find_lane_polynomials(binary_warped, output_image_file_name=None):
-    # Assuming you have created a warped binary image called "binary_warped"
-    # Take a histogram of the bottom half of the image
-    histogram = np.sum(binary_warped[binary_warped.shape[0] // 2:, :], axis=0)
+from polyfit import PolyMoments
+
+
+class PixelIndex:
+    # The nonzero pixels of a binary image, bucketed by rows. Built once per
+    # frame, a query reads only the pixels of the rows it covers.
+    def __init__(self, binary):
+        self.shape = binary.shape
+        # Row-major order, so the pixels of a row range are contiguous.
+        # findNonZero is several times faster than numpy's nonzero()
+        points = cv2.findNonZero(np.ascontiguousarray(binary, np.uint8))
+        points = np.zeros((0, 2), np.int32) if points is None else points.reshape(-1, 2)
+        self.nonzerox = points[:, 0]
+        self.nonzeroy = points[:, 1]
+        self.row_starts = np.searchsorted(self.nonzeroy, np.arange(binary.shape[0] + 1))
+
+    def rows(self, y_low, y_high):
+        # Index range of the pixels with y_low <= y < y_high
+        y_low = min(max(y_low, 0), self.shape[0])
+        y_high = min(max(y_high, y_low), self.shape[0])
+        return self.row_starts[y_low], self.row_starts[y_high]
+
+    def window(self, y_low, y_high, x_low, x_high):
+        # Indices of the pixels inside the window
+        (start, end) = self.rows(y_low, y_high)
+        x = self.nonzerox[start:end]
+        return ((x >= x_low) & (x < x_high)).nonzero()[0] + start
+
+    def histogram(self, y_low, y_high):
+        # Number of pixels of each column in the rows
+        (start, end) = self.rows(y_low, y_high)
+        return np.bincount(self.nonzerox[start:end], minlength=self.shape[1])
+
+
+def find_lane_bases_batch(binary_warped_batch):
+    # Histogram peaks of a (N, H, W) batch of warped binary images,
+    # returns the (N,) arrays of left and right starting x positions
+    height = binary_warped_batch.shape[1]
+    # Take a histogram of the bottom half of the images
+    histograms = np.sum(binary_warped_batch[:, height // 2:, :], axis=1)
+    return find_histogram_peaks(histograms)
+
+
+def find_histogram_peaks(histograms):
+    # Left and right peaks of a (N, W) array of histograms
+    width = histograms.shape[1]
 
     # Avoid lines on the side
-    histogram[0:100] = 0
-    histogram[binary_warped.shape[1] - 100:binary_warped.shape[1]] = 0
+    histograms[:, 0:100] = 0
+    histograms[:, width - 100:width] = 0
 
     if config.VISUALIZE_LANE_FINDING_HISTOGRAM:
-        plt.plot(histogram)
-        plt.show()
+        for histogram in histograms:
+            plt.plot(histogram)
+            plt.show()
+
+    # Find the peak of the left and right halves of the histogram
+    # These will be the starting point for the left and right lines
+    midpoint = int(width / 2)
+    leftx_bases = np.argmax(histograms[:, :midpoint], axis=1)
+    rightx_bases = np.argmax(histograms[:, midpoint:], axis=1) + midpoint
+    return leftx_bases, rightx_bases
+
+
+def find_lane_polynomials_batch(binary_warped_batch):
+    # Sliding window search over a (N, H, W) batch, the histograms are
+    # calculated in one pass. Frames without a fit get None.
+    leftx_bases, rightx_bases = find_lane_bases_batch(binary_warped_batch)
+    results = []
+    for binary_warped, leftx_base, rightx_base in zip(binary_warped_batch, leftx_bases, rightx_bases):
+        try:
+            results.append(find_lane_polynomials(
+                binary_warped, bases=(leftx_base, rightx_base)))
+        except Exception:
+            results.append(None)
+    return results
+
+
+def find_lane_polynomials(binary_warped, output_image_file_name=None, bases=None,
+                          index=None):
+    # Assuming you have created a warped binary image called "binary_warped"
+    # index: PixelIndex of binary_warped, if it is already built
+    if index is None:
+        index = PixelIndex(binary_warped)
+    if bases is None:
+        # Take a histogram of the bottom half of the image
+        histogram = index.histogram(binary_warped.shape[0] // 2, binary_warped.shape[0])
+        leftx_bases, rightx_bases = find_histogram_peaks(histogram[np.newaxis])
+        bases = (leftx_bases[0], rightx_bases[0])
+    (leftx_base, rightx_base) = bases
 
     # Create an output image to draw on and visualize the result
     if config.VISUALIZE_LANE_FINDING or output_image_file_name is not None:
         out_img = np.uint8(
             np.dstack((binary_warped, binary_warped, binary_warped)) * 255)
 
-    # Find the peak of the left and right halves of the histogram
-    # These will be the starting point for the left and right lines
-    midpoint = np.int(histogram.shape[0] / 2)
-    leftx_base = np.argmax(histogram[:midpoint])
-    rightx_base = np.argmax(histogram[midpoint:]) + midpoint
-
     # Choose the number of sliding windows
     nwindows = 9
     # Set height of windows
-    window_height = np.int(binary_warped.shape[0] / nwindows)
-    # Identify the x and y positions of all nonzero pixels in the image
-    nonzero = binary_warped.nonzero()
-    nonzeroy = np.array(nonzero[0])
-    nonzerox = np.array(nonzero[1])
+    window_height = int(binary_warped.shape[0] / nwindows)
+    # The x and y positions of all nonzero pixels in the image
+    nonzeroy = index.nonzeroy
+    nonzerox = index.nonzerox
     # Current positions to be updated for each window
     leftx_current = leftx_base
     rightx_current = rightx_base
@@ -63,24 +133,71 @@ def find_lane_polynomials(binary_warped, output_image_file_name=None):
             cv2.rectangle(out_img, (win_xright_low, win_y_low),
                           (win_xright_high, win_y_high), (0, 255, 0), 2)
         # Identify the nonzero pixels in x and y within the window
-        good_left_inds = ((nonzeroy >= win_y_low) & (nonzeroy < win_y_high) & (
-            nonzerox >= win_xleft_low) & (nonzerox < win_xleft_high)).nonzero()[0]
-        good_right_inds = ((nonzeroy >= win_y_low) & (nonzeroy < win_y_high) & (
-            nonzerox >= win_xright_low) & (nonzerox < win_xright_high)).nonzero()[0]
+        good_left_inds = index.window(win_y_low, win_y_high, win_xleft_low, win_xleft_high)
+        good_right_inds = index.window(win_y_low, win_y_high, win_xright_low, win_xright_high)
         # Append these indices to the lists
         left_lane_inds.append(good_left_inds)
         right_lane_inds.append(good_right_inds)
         # If you found > minpix pixels, recenter next window on their mean
         # position
         if len(good_left_inds) > minpix:
-            leftx_current = np.int(np.mean(nonzerox[good_left_inds]))
+            leftx_current = int(np.mean(nonzerox[good_left_inds]))
         if len(good_right_inds) > minpix:
-            rightx_current = np.int(np.mean(nonzerox[good_right_inds]))
+            rightx_current = int(np.mean(nonzerox[good_right_inds]))
 
     # Concatenate the arrays of indices
     left_lane_inds = np.concatenate(left_lane_inds)
     right_lane_inds = np.concatenate(right_lane_inds)
 
+    if config.VISUALIZE_LANE_FINDING or output_image_file_name is not None:
+        return fit_lane_polynomials(binary_warped.shape, nonzerox, nonzeroy,
+                                    left_lane_inds, right_lane_inds,
+                                    out_img, output_image_file_name)
+    return fit_lane_polynomials(binary_warped.shape, nonzerox, nonzeroy,
+                                left_lane_inds, right_lane_inds)
+
+
+def find_lane_polynomials_near(binary_warped, left_poly, right_poly, output_image_file_name=None,
+                               index=None):
+    # Search only in a band around the polynomials of the previous frame
+    if index is None:
+        index = PixelIndex(binary_warped)
+    nonzeroy = index.nonzeroy
+    nonzerox = index.nonzerox
+    # Set the width of the band +/- margin
+    margin = 100
+
+    left_center = left_poly[0] * nonzeroy**2 + left_poly[1] * nonzeroy + left_poly[2]
+    right_center = right_poly[0] * nonzeroy**2 + right_poly[1] * nonzeroy + right_poly[2]
+    left_lane_inds = ((nonzerox > left_center - margin) &
+                      (nonzerox < left_center + margin)).nonzero()[0]
+    right_lane_inds = ((nonzerox > right_center - margin) &
+                       (nonzerox < right_center + margin)).nonzero()[0]
+
+    if config.VISUALIZE_LANE_FINDING or output_image_file_name is not None:
+        out_img = np.uint8(
+            np.dstack((binary_warped, binary_warped, binary_warped)) * 255)
+        return fit_lane_polynomials(binary_warped.shape, nonzerox, nonzeroy,
+                                    left_lane_inds, right_lane_inds,
+                                    out_img, output_image_file_name)
+    return fit_lane_polynomials(binary_warped.shape, nonzerox, nonzeroy,
+                                left_lane_inds, right_lane_inds)
+
+
+def find_lane_polynomials_for_lane(binary_warped, lane_object, output_image_file_name=None,
+                                   fast=False):
+    # Track the lane while the last fits are recent enough, otherwise
+    # fall back to the full sliding window search. The fast search keeps
+    # tracking as long as the lane is valid.
+    trackable = lane_object.is_valid() if fast else lane_object.is_trackable()
+    if trackable:
+        return find_lane_polynomials_near(binary_warped, lane_object.left_poly,
+                                          lane_object.right_poly, output_image_file_name)
+    return find_lane_polynomials(binary_warped, output_image_file_name)
+
+
+def fit_lane_polynomials(image_shape, nonzerox, nonzeroy, left_lane_inds, right_lane_inds,
+                         out_img=None, output_image_file_name=None):
     # Extract left and right line pixel positions
     leftx = nonzerox[left_lane_inds]
     lefty = nonzeroy[left_lane_inds]
@@ -88,26 +205,25 @@ def find_lane_polynomials(binary_warped, output_image_file_name=None):
     righty = nonzeroy[right_lane_inds]
 
     # Fit a second order polynomial to each
-    if leftx.shape[0] == 0 or lefty.shape[0] == 0 or rightx.shape[0] == 0 or righty.shape[0] == 0:
+    if leftx.shape[0] < 3 or rightx.shape[0] < 3:
         raise Exception('No good data')
-    left_fit = np.polyfit(lefty, leftx, 2)
-    right_fit = np.polyfit(righty, rightx, 2)
+    left_moments = PolyMoments.from_pixels(leftx, lefty, image_shape[0])
+    right_moments = PolyMoments.from_pixels(rightx, righty, image_shape[0])
+    left_fit = left_moments.solve()
+    right_fit = right_moments.solve()
 
     # Generate x and y values for plotting
-    ploty = np.linspace(0, binary_warped.shape[0] - 1, 30)
+    ploty = np.linspace(0, image_shape[0] - 1, 30)
     left_fitx = left_fit[0] * ploty**2 + left_fit[1] * ploty + left_fit[2]
     right_fitx = right_fit[0] * ploty**2 + right_fit[1] * ploty + right_fit[2]
 
-    if config.VISUALIZE_LANE_FINDING or output_image_file_name is not None:
-        out_img[nonzeroy[left_lane_inds],
-                nonzerox[left_lane_inds]] = [255, 0, 0]
-        out_img[nonzeroy[right_lane_inds],
-                nonzerox[right_lane_inds]] = [0, 0, 255]
+    if out_img is not None:
+        out_img[lefty, leftx] = [255, 0, 0]
+        out_img[righty, rightx] = [0, 0, 255]
 
-    left_points = np.stack([left_fitx, ploty]).T
-    right_points = np.stack([right_fitx, ploty]).T
+        left_points = np.stack([left_fitx, ploty]).T
+        right_points = np.stack([right_fitx, ploty]).T
 
-    if config.VISUALIZE_LANE_FINDING or output_image_file_name is not None:
         cv2.polylines(out_img, [np.int32(left_points)], False, (0, 255, 0), 4)
         cv2.polylines(out_img, [np.int32(right_points)], False, (0, 255, 0), 4)
         if config.VISUALIZE_LANE_FINDING:
@@ -117,4 +233,4 @@ def find_lane_polynomials(binary_warped, output_image_file_name=None):
         if output_image_file_name is not None:
             cv2.imwrite(output_image_file_name, out_img)
 
-    return (left_fit, right_fit, left_fitx, right_fitx, ploty)
+    return (left_fit, right_fit, left_fitx, right_fitx, ploty, left_moments, right_moments)
@@ -0,0 +1,200 @@
+"""
+Lane tracking of many camera streams in arrays
+
+LaneTracker keeps the state of a Lane for each of N streams in contiguous
+arrays, one row per stream, and updates the streams that got a frame in a
+tick all at once: the sanity check, the refit from the pixel history (or the
+polynomial blending), the curvature and the age are numpy operations over
+their rows. A stream takes about 250 bytes. The points of the drawn lane are
+not kept, they are calculated from the smoothed polynomials when needed.
+
+lane(stream) is a view of one stream that reads like a Lane, so lane
+finding, drawing and telemetry work on it unchanged.
+"""
+
+import numpy as np
+
+from lane import (Lane, DEFAULT_SANITY_LIMITS, is_sane, find_curvature, find_lane_center,
+                  find_relative_car_position)
+from polyfit import solve_moments
+
+
+class LaneTracker:
+    # The streams arguments are arrays or lists of stream indices, each
+    # stream at most once per call
+    def __init__(self, streams, image_shape, frame_period=None,
+                 sanity_limits=DEFAULT_SANITY_LIMITS):
+        self.streams = streams
+        self.image_shape = image_shape
+        self.image_center_x = image_shape[1] / 2.0
+        self.y_scale = float(image_shape[0])
+        self.frame_period = frame_period
+        self.sanity_limits = sanity_limits
+        self.plot_y = np.linspace(0, image_shape[0] - 1, 30)
+
+        self.age = np.full(streams, Lane.MAX_AGE, np.float64)
+        self.frame = np.zeros(streams, np.uint8)
+        self.time = np.full(streams, np.nan)
+        self.last_sane_time = np.full(streams, np.nan)
+
+        # The smoothed [left, right] polynomials, NaN before the first sane frame
+        self.polys = np.full((streams, 2, 3), np.nan)
+        # The PolyMoments sums of [left, right], the 5 y_moments then the
+        # 3 xy_moments, and whether there are any
+        self.moments = np.zeros((streams, 2, 8))
+        self.has_moments = np.zeros(streams, bool)
+
+        self.center_x = np.full(streams, np.nan)
+        self.radius_of_curvature_m = np.full(streams, np.nan) # meters
+        self.relative_car_position_m = np.full(streams, np.nan) # meters
+        self.radius_of_curvature_for_display_m = np.full(streams, np.nan)
+        self.relative_car_position_for_display_m = np.full(streams, np.nan)
+
+    def lane(self, stream):
+        return LaneView(self, stream)
+
+    def is_up_to_date(self, streams=slice(None)):
+        return self.age[streams] == 1
+
+    def is_valid(self, streams=slice(None)):
+        return self.age[streams] < Lane.MAX_AGE
+
+    def is_trackable(self, streams=slice(None)):
+        return self.is_valid(streams) & (self.age[streams] <= Lane.MAX_TRACKING_FAILURES)
+
+    def set_time(self, streams, timestamps):
+        # Lane.set_time of the streams
+        streams = np.asarray(streams, np.intp)
+        timestamps = np.asarray(timestamps, np.float64)
+        self.time[streams] = timestamps
+        if self.frame_period is not None:
+            frames = (timestamps - self.last_sane_time[streams]) / self.frame_period
+            known = ~np.isnan(frames)
+            self.age[streams[known]] = np.clip(frames[known], 1, Lane.MAX_AGE)
+
+    def update(self, streams, plot_y, left_polys, right_polys, left_moments=None,
+               right_moments=None):
+        # Lane.update of the streams, with the polynomials (streams, 3) found
+        # in their frames and optionally the PolyMoments of their pixels
+        streams = np.asarray(streams, np.intp)
+        polys = np.stack([np.asarray(left_polys, np.float64),
+                          np.asarray(right_polys, np.float64)], 1)
+
+        # The lines at the first and the last plot point, as lane finding plots them
+        y = np.asarray(plot_y, np.float64)[[0, -1]]
+        plot_x = polys[..., 0:1] * y**2 + polys[..., 1:2] * y + polys[..., 2:3]
+        sane = is_sane(plot_x[:, 0].T, plot_x[:, 1].T, self.sanity_limits)
+        self.update_insane(streams[~sane])
+        sane_indices = np.flatnonzero(sane)
+        streams = streams[sane_indices]
+        polys = polys[sane_indices]
+        if len(streams) == 0:
+            return
+
+        if left_moments is not None and right_moments is not None:
+            moments = np.stack([self.stack_moments([left_moments[i] for i in sane_indices]),
+                                self.stack_moments([right_moments[i] for i in sane_indices])], 1)
+            keep = self.is_valid(streams) & self.has_moments[streams]
+            factor = np.where(keep, Lane.FORGETTING_FACTOR ** self.age[streams], 0.0)
+            moments += self.moments[streams] * factor[:, np.newaxis, np.newaxis]
+            self.moments[streams] = moments
+            self.has_moments[streams] = True
+            self.polys[streams] = solve_moments(moments[..., :5], moments[..., 5:], self.y_scale)
+        else:
+            blend = self.is_valid(streams)[:, np.newaxis, np.newaxis]
+            a = Lane.FORGETTING_FACTOR ** self.age[streams][:, np.newaxis, np.newaxis]
+            self.polys[streams] = np.where(blend, a * self.polys[streams] + (1-a) * polys, polys)
+
+        # Curvature and position of this frame, from its polynomials
+        y_eval = np.max(plot_y)
+        self.radius_of_curvature_m[streams] = find_curvature(polys[:, 0], polys[:, 1], y_eval)
+        self.center_x[streams] = find_lane_center(polys[:, 0], polys[:, 1], y_eval)
+        self.relative_car_position_m[streams] = find_relative_car_position(
+            self.center_x[streams], self.image_center_x)
+        shown = streams[self.frame[streams] == 0]
+        self.radius_of_curvature_for_display_m[shown] = self.radius_of_curvature_m[shown]
+        self.relative_car_position_for_display_m[shown] = self.relative_car_position_m[shown]
+        self.frame[streams] = (self.frame[streams] + 1) % Lane.TEXT_CHANGE_AFTER_FRAMES
+        self.age[streams] = 1
+        self.last_sane_time[streams] = self.time[streams]
+        self.plot_y = plot_y
+
+    def update_insane(self, streams):
+        streams = np.asarray(streams, np.intp)
+        self.age[streams] = np.minimum(self.age[streams] + 1, Lane.MAX_AGE)
+
+    def stack_moments(self, moments_list):
+        # PolyMoments to rows of self.moments
+        if any(moments.y_scale != self.y_scale for moments in moments_list):
+            raise ValueError('PolyMoments of another image height')
+        return np.array([np.concatenate([moments.y_moments, moments.xy_moments])
+                         for moments in moments_list]).reshape(-1, 8)
+
+
+class LaneView:
+    # One stream of a LaneTracker with the attributes and methods of a Lane.
+    # It reads the tracker's current state, updates go through the tracker.
+    def __init__(self, tracker, stream):
+        self.tracker = tracker
+        self.stream = stream
+        self.image_shape = tracker.image_shape
+
+    @property
+    def age(self):
+        return float(self.tracker.age[self.stream])
+
+    def is_up_to_date(self):
+        return self.age == 1
+
+    def is_valid(self):
+        return self.age < Lane.MAX_AGE
+
+    def is_trackable(self):
+        return self.is_valid() and self.age <= Lane.MAX_TRACKING_FAILURES
+
+    @property
+    def left_poly(self):
+        return self._poly(0)
+
+    @property
+    def right_poly(self):
+        return self._poly(1)
+
+    def _poly(self, line):
+        poly = self.tracker.polys[self.stream, line]
+        return None if np.isnan(poly[0]) else poly.copy()
+
+    @property
+    def points(self):
+        if self.left_poly is None:
+            return None
+        plot_y = self.tracker.plot_y
+        left_x = np.polyval(self.left_poly, plot_y)
+        right_x = np.polyval(self.right_poly, plot_y)
+        points_left = np.array([np.transpose(np.vstack([left_x, plot_y]))])
+        points_right = np.array([np.flipud(np.transpose(np.vstack([right_x, plot_y])))])
+        return np.hstack((points_left, points_right))
+
+    @property
+    def center_x(self):
+        return self._value(self.tracker.center_x)
+
+    @property
+    def radius_of_curvature_m(self):
+        return self._value(self.tracker.radius_of_curvature_m)
+
+    @property
+    def relative_car_position_m(self):
+        return self._value(self.tracker.relative_car_position_m)
+
+    @property
+    def radius_of_curvature_for_display_m(self):
+        return self._value(self.tracker.radius_of_curvature_for_display_m)
+
+    @property
+    def relative_car_position_for_display_m(self):
+        return self._value(self.tracker.relative_car_position_for_display_m)
+
+    def _value(self, values):
+        value = values[self.stream]
+        return None if np.isnan(value) else float(value)
@@ -0,0 +1,162 @@
+"""
+Live mode: lane finding on a camera or a stream in real time
+
+A capture thread reads frames as they come and keeps only the newest one, so
+when processing falls behind frames are dropped instead of queued. Every frame
+is timestamped when it is captured. The end-to-end latency, from capture to
+the written output, is checked against a budget: over it the pipeline
+steps down to a cheaper fast path (see config.py) until the latency has
+recovered.
+"""
+
+import collections
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import config
+from frame_io import FrameSource
+from lane import Lane
+from pipeline import FrameContext, process_image
+from profiling import NULL_PROFILER
+
+
+class LatestFrameSource(FrameSource):
+    # A camera device number, a stream URL or a video file. Iterating yields
+    # (timestamp, frame) with the newest frame captured since the last one.
+    # A file stands in for a stream: with pace it is released at its fps.
+    def __init__(self, file_name_or_device, pace=None):
+        self.capture = cv2.VideoCapture(file_name_or_device)
+        if not self.capture.isOpened():
+            raise IOError('Cannot open video: {0}'.format(file_name_or_device))
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or FrameSource.fps
+        self.frame_size = (int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                           int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        if pace is None:
+            pace = isinstance(file_name_or_device, str) and os.path.isfile(file_name_or_device)
+        self.pace = pace
+
+        self.condition = threading.Condition()
+        self.frame = None
+        self.timestamp = None
+        self.captured = 0
+        self.dropped = 0
+        self.finished = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        next_time = time.monotonic()
+        while not self.stopped:
+            ret, frame = self.capture.read()
+            if not ret:
+                break
+            if self.pace:
+                time.sleep(max(next_time - time.monotonic(), 0))
+                next_time += 1.0 / self.fps
+            timestamp = time.monotonic()
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            with self.condition:
+                if self.frame is not None:
+                    self.dropped += 1
+                self.frame = frame
+                self.timestamp = timestamp
+                self.captured += 1
+                self.condition.notify()
+        with self.condition:
+            self.finished = True
+            self.condition.notify()
+
+    def __iter__(self):
+        while True:
+            with self.condition:
+                while self.frame is None and not self.finished:
+                    self.condition.wait()
+                if self.frame is None:
+                    return
+                item = (self.timestamp, self.frame)
+                self.frame = None
+            yield item
+
+    def close(self):
+        self.stopped = True
+        self.thread.join()
+        self.capture.release()
+
+
+class LiveStats:
+    def __init__(self, latency_budget=None):
+        self.latency_budget = latency_budget
+        self.latencies = []
+        self.processing_times = []
+        self.fast_frames = 0
+        self.captured = 0
+        self.dropped = 0
+
+    def record(self, latency, processing_time, fast_search):
+        self.latencies.append(latency)
+        self.processing_times.append(processing_time)
+        self.fast_frames += fast_search
+
+    def summary(self):
+        summary = collections.OrderedDict([
+            ('captured', self.captured), ('processed', len(self.latencies)),
+            ('dropped', self.dropped), ('fast_search', self.fast_frames)])
+        for name, seconds in [('latency', self.latencies),
+                              ('processing', self.processing_times)]:
+            if not seconds:
+                continue
+            p50, p95, p99 = np.percentile(np.array(seconds) * 1000, [50, 95, 99])
+            summary[name + '_p50_ms'] = p50
+            summary[name + '_p95_ms'] = p95
+            summary[name + '_p99_ms'] = p99
+            summary[name + '_max_ms'] = max(seconds) * 1000
+        if self.latency_budget is not None and self.latencies:
+            summary['over_budget'] = int(np.sum(np.array(self.latencies) > self.latency_budget))
+        return summary
+
+    def print_summary(self):
+        for name, value in self.summary().items():
+            if isinstance(value, float):
+                print('{0:<20} {1:9.2f}'.format(name, value))
+            else:
+                print('{0:<20} {1:9d}'.format(name, value))
+
+
+def process_live(source, camera, sink=None, latency_budget=None, profiler=NULL_PROFILER,
+                 max_frames=None):
+    # Processes the frames of a LatestFrameSource until it ends, returns the LiveStats
+    if latency_budget is None:
+        latency_budget = config.LIVE_LATENCY_BUDGET
+    lane_object = Lane(camera.image_shape, 1.0 / source.fps)
+    context = FrameContext(camera.image_shape)
+    stats = LiveStats(latency_budget)
+    fast_search = False
+
+    for timestamp, frame in source:
+        start = time.monotonic()
+        output = process_image(frame, camera, lane_object, profiler, context,
+                               timestamp, fast_search)
+        if sink is not None:
+            with profiler.stage('write'):
+                sink.write(output)
+        profiler.end_frame()
+        end = time.monotonic()
+
+        latency = end - timestamp
+        stats.record(latency, end - start, fast_search)
+        if latency > latency_budget:
+            fast_search = True
+        elif latency < config.LIVE_RECOVERY_FRACTION * latency_budget:
+            fast_search = False
+
+        if max_frames is not None and len(stats.latencies) >= max_frames:
+            break
+
+    stats.captured = source.captured
+    stats.dropped = source.dropped
+    return stats
@@ -1,17 +1,42 @@
+"""
+Advanced lane finding on videos, images and live streams
+
+    python main.py process "cuts/*.mp4" --output-dir out --jobs 4
+    python main.py process "cuts/*.mp4" --output-dir out --no-render
+    python main.py demo
+    python main.py live 0 --show
+
+Videos whose output exists are skipped, so an interrupted run is resumed by
+running it again. With --no-render only the lanes of every frame are written,
+to a telemetry file (see telemetry.py).
+"""
+
+import argparse
+import concurrent.futures
 import glob
+import os
+import sys
+import time
 
 import cv2
 import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
 import numpy as np
-from moviepy.editor import VideoFileClip
 
 # My modules
+import config
 from camera import Camera
+from frame_io import VideoCaptureSource, VideoFileSink, WindowSink, NullSink
+from live import LatestFrameSource, process_live
+from async_pipeline import process_stream_async
+from frame_cache import CachedVideo, get_frame_cache
 from lane import Lane
+from pipeline import (FrameContext, finish_frames, process_image, process_stream,
+                      process_stream_telemetry, write_frames)
+from telemetry import TelemetryWriter, get_telemetry_file_name
+from profiling import FrameProfiler, NULL_PROFILER
 import thresholding
 import lane_finding
-import lane_drawing
 
 
 def plot_side_by_side(title1, img1, title2, img2, targetFileName=None):
@@ -71,41 +96,123 @@ def create_demo_images(camera):
     plot_side_by_side("Undistorted", undistorted, "Warped",
                       warped, "output_images/warped.png")
 
-def process_image(img, camera, lane_object=None):
-    if lane_object is None:
-        lane_object = Lane(img.shape)
+def get_out_file_name(file_name, output_dir=None):
+    (root, ext) = os.path.splitext(file_name)
+    out_file_name = root + '_out' + ext
+    if output_dir is not None:
+        out_file_name = os.path.join(output_dir, os.path.basename(out_file_name))
+    return out_file_name
 
-    img = camera.undistort(img)
-    undist = np.copy(img)
 
-    img = thresholding.threshold(img)
+def get_part_file_name(file_name):
+    # Outputs are written to this name and renamed when complete
+    (root, ext) = os.path.splitext(file_name)
+    return root + '.part' + ext
 
-    img = camera.warp(img)
 
+def process_video_file(file_name, camera, workers=1, queue_depth=None,
+                       profile=False, profile_file_name=None, pipelined=False,
+                       output_file_name=None, frame_cache_dir=None,
+                       telemetry_file_name=None, render=True, fourcc=None,
+                       track_allocations=False):
+    # With profile, prints the stage times at the end; profile_file_name
+    # (.csv or .json) gets the times of every frame. track_allocations adds
+    # the memory allocated by each stage, which slows the pipeline down. pipelined overlaps
+    # decoding, processing and encoding, with workers compute threads; it
+    # prints its stage occupancy and queue depths with profile.
+    # The output is written to a temporary file and renamed when complete,
+    # so an existing output is never a partial one. Returns the frame count.
+    # With a frame cache (frame_cache_dir or config.FRAME_CACHE_DIR) the
+    # decoded frames and the intermediates are read from it or recorded.
+    # telemetry_file_name gets the lane of every frame; without render that
+    # is the only output, nothing is drawn or encoded. fourcc is the codec
+    # of the output video, or a list of codecs to try (see VideoFileSink).
+    if output_file_name is None:
+        output_file_name = get_out_file_name(file_name)
+    if not render and telemetry_file_name is None:
+        telemetry_file_name = get_telemetry_file_name(file_name)
+    if pipelined and telemetry_file_name is not None:
+        raise ValueError('The pipelined mode does not record telemetry')
+    if pipelined and (profile_file_name is not None or track_allocations):
+        raise ValueError('The pipelined mode only profiles its stages and queues')
+
+    profile = profile or profile_file_name is not None or track_allocations
+    # The pipelined mode has its own stage statistics
+    profiler = FrameProfiler(track_allocations) if profile and not pipelined else NULL_PROFILER
+    cache = get_frame_cache(frame_cache_dir)
+    source = VideoCaptureSource(file_name) if cache is None else CachedVideo(file_name, cache)
+    part_file_name = get_part_file_name(output_file_name)
+    telemetry = None
+    if telemetry_file_name is not None:
+        telemetry = TelemetryWriter(telemetry_file_name, source.fps, os.path.basename(file_name))
     try:
-        (left_poly, right_poly, left_fitx, right_fitx,
-         ploty) = lane_finding.find_lane_polynomials(img)
-        lane_object.update(left_fitx, right_fitx, ploty, left_poly, right_poly)
-    except Exception as e:
-        print('Exception:', e)
-        lane_object.update_insane()
+        with source:
+            if not render:
+                frame_count = process_stream_telemetry(source, telemetry, camera, workers,
+                                                       queue_depth, profiler)
+            else:
+                with VideoFileSink(part_file_name, source.fps, source.frame_size,
+                                   fourcc) as sink:
+                    if pipelined:
+                        stats = process_stream_async(source, sink, camera, max(workers, 1),
+                                                     compute_depth=queue_depth)
+                        frame_count = stats.frames
+                    elif cache is not None:
+                        context = FrameContext(camera.image_shape)
+                        prepared = source.prepared_frames(camera, workers, queue_depth,
+                                                          profiler, context)
+                        frame_count = write_frames(
+                            finish_frames(prepared, camera, Lane(camera.image_shape), profiler,
+                                          context, telemetry), sink, profiler)
+                    else:
+                        frame_count = process_stream(source, sink, camera, workers,
+                                                     queue_depth, profiler, telemetry)
+                os.replace(part_file_name, output_file_name)
+    except BaseException:
+        if telemetry is not None:
+            telemetry.abort()
+        if os.path.exists(part_file_name):
+            os.remove(part_file_name)
+        raise
+    if telemetry is not None:
+        telemetry.close()
 
-    return lane_drawing.draw_all(undist, lane_object, camera)
+    if pipelined and profile:
+        stats.print_summary()
+    if profiler.enabled:
+        profiler.print_summary(file_name)
+        if profile_file_name is not None:
+            profiler.write_frames(profile_file_name)
+    return frame_count
 
 
-def get_out_file_name(file_name):
-    file_name_parts = file_name.split('.')
-    file_name_parts[0] = file_name_parts[0] + '_out'
-    return '.'.join(file_name_parts)
+def get_profile_file_name(profile_file_name, file_name, several_videos):
+    if profile_file_name is None or not several_videos:
+        return profile_file_name
+    (root, ext) = os.path.splitext(profile_file_name)
+    return '{0}_{1}{2}'.format(root, os.path.splitext(os.path.basename(file_name))[0], ext)
 
 
-def process_video_file(file_name, camera):
-    lane_object = Lane(camera.image_shape)
+def process_live_stream(file_name_or_device, camera, output_file_name=None, show=False,
+                        latency_budget=None, profile=False, track_allocations=False):
+    # A camera device number or a stream URL, a video file is played in real time.
+    # The output goes to output_file_name, a window with show, or nowhere.
+    profile = profile or track_allocations
+    profiler = FrameProfiler(track_allocations) if profile else NULL_PROFILER
+    with LatestFrameSource(file_name_or_device) as source:
+        if output_file_name is not None:
+            sink = VideoFileSink(output_file_name, source.fps, source.frame_size)
+        elif show:
+            sink = WindowSink()
+        else:
+            sink = NullSink()
+        with sink:
+            stats = process_live(source, camera, sink, latency_budget, profiler)
 
-    src_clip = VideoFileClip(file_name)
-    dst_clip = src_clip.fl_image(
-        lambda frame: process_image(frame, camera, lane_object))
-    dst_clip.write_videofile(get_out_file_name(file_name), audio=False)
+    stats.print_summary()
+    if profiler.enabled:
+        profiler.print_summary()
+    return stats
 
 
 def process_test_images(camera):
@@ -117,10 +224,177 @@ def process_test_images(camera):
             exit()
 
 
-CAMERA = Camera([720, 1280, 3], 'camera_cal/calibration*.jpg',
-                9, 6, 'camera_calibration.p')
+def expand_file_patterns(patterns):
+    # File names and globs, in order and without duplicates
+    file_names = []
+    for pattern in patterns:
+        for file_name in sorted(glob.glob(pattern)) or [pattern]:
+            if file_name not in file_names:
+                file_names.append(file_name)
+    return file_names
+
+
+# The camera of a job worker process, loaded once by the pool initializer
+_job_camera = None
+
+def _init_job_worker(camera_args):
+    # The calibration is already in the store, so this only maps its arrays
+    global _job_camera
+    _job_camera = Camera(*camera_args)
+
+def _process_video_job(file_name, options):
+    # options are the keyword arguments of process_video_file
+    start = time.perf_counter()
+    frame_count = process_video_file(file_name, _job_camera, **options)
+    return frame_count, time.perf_counter() - start
+
+
+def process_video_files(file_names, camera_args, jobs=1, workers=1, output_dir=None,
+                        pipelined=False, force=False, frame_cache_dir=None, telemetry=False,
+                        render=True, fourcc=None, profile=False, profile_file_name=None,
+                        track_allocations=False):
+    # Processes the videos in jobs worker processes, longest first, skipping
+    # the ones whose outputs exist unless force. The outputs are the rendered
+    # video with render, and the telemetry with telemetry or without render.
+    # With several videos, profile_file_name gets the name of each video
+    # before its extension. Returns the failed file names.
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    todo = []
+    for file_name in file_names:
+        output_file_name = get_out_file_name(file_name, output_dir)
+        telemetry_file_name = None
+        if telemetry or not render:
+            telemetry_file_name = get_telemetry_file_name(file_name, output_dir)
+        outputs = [name for name in [output_file_name if render else None, telemetry_file_name]
+                   if name is not None]
+        if all(os.path.exists(name) for name in outputs) and not force:
+            print('Skipping {0}, {1} exists'.format(file_name, ' and '.join(outputs)))
+        else:
+            options = {'workers': workers, 'pipelined': pipelined,
+                       'output_file_name': output_file_name, 'frame_cache_dir': frame_cache_dir,
+                       'telemetry_file_name': telemetry_file_name, 'render': render,
+                       'fourcc': fourcc, 'profile': profile,
+                       'profile_file_name': get_profile_file_name(
+                           profile_file_name, file_name, len(file_names) > 1),
+                       'track_allocations': track_allocations}
+            todo.append((file_name, options))
+    todo.sort(key=lambda job: os.path.getsize(job[0]) if os.path.exists(job[0]) else 0,
+              reverse=True)
+
+    # Calibrate here if needed, so the workers only load the stored calibration
+    Camera(*camera_args)
+
+    failed = []
+    total_frames = 0
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(
+            jobs, initializer=_init_job_worker, initargs=(camera_args,)) as executor:
+        futures = {executor.submit(_process_video_job, file_name, options): file_name
+                   for file_name, options in todo}
+        for future in concurrent.futures.as_completed(futures):
+            file_name = futures[future]
+            try:
+                frame_count, seconds = future.result()
+            except Exception as e:
+                print('Failed {0}: {1}'.format(file_name, e))
+                failed.append(file_name)
+                continue
+            total_frames += frame_count
+            print('{0:<40} {1:6d} frames {2:8.1f} s {3:7.1f} fps'.format(
+                file_name, frame_count, seconds, frame_count / seconds if seconds else 0.0))
+    seconds = time.perf_counter() - start
+
+    print('{0} videos, {1} skipped, {2} failed, {3} frames in {4:.1f} s, {5:.1f} fps'.format(
+        len(todo) - len(failed), len(file_names) - len(todo), len(failed), total_frames,
+        seconds, total_frames / seconds if seconds else 0.0))
+    return failed
+
+
+def add_profile_arguments(parser):
+    parser.add_argument('--profile', action='store_true',
+                        help='print the time of every pipeline stage at the end')
+    parser.add_argument('--track-allocations', action='store_true',
+                        help='profile the memory allocated by every stage too (slower)')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--calibration-images', default='camera_cal/calibration*.jpg')
+    parser.add_argument('--calibration-store', default='camera_calibration')
+    parser.add_argument('--camera-id', default='default')
+    parser.add_argument('--threshold-tables',
+                        help='directory storing the threshold lookup tables, so they are '
+                             'built only once (default: built in memory by every process)')
+    commands = parser.add_subparsers(dest='command')
+
+    process = commands.add_parser('process', help='process video files')
+    process.add_argument('videos', nargs='+', help='video files or globs, e.g. "cuts/*.mp4"')
+    process.add_argument('--output-dir', help='default: next to each video')
+    process.add_argument('--jobs', type=int,
+                         help='videos processed at once, in worker processes '
+                              '(default: CPU count / workers)')
+    process.add_argument('--workers', type=int, default=1,
+                         help='processes computing the frames of each video, or threads '
+                              'with --pipelined; jobs x workers should not exceed the CPUs')
+    process.add_argument('--pipelined', action='store_true',
+                         help='overlap decoding, processing and encoding')
+    process.add_argument('--force', action='store_true',
+                         help='process videos whose output already exists')
+    process.add_argument('--frame-cache', help='directory caching the decoded frames')
+    process.add_argument('--telemetry', action='store_true',
+                         help='also write the lanes of every frame to a .telemetry directory')
+    process.add_argument('--no-render', action='store_true',
+                         help='only write the telemetry, without drawing and encoding')
+    process.add_argument('--fourcc', nargs='+',
+                         help='codecs of the output videos, the first that works is used '
+                              '(default: avc1 mp4v)')
+    add_profile_arguments(process)
+    process.add_argument('--profile-file',
+                         help='.csv or .json file for the stage times of every frame')
+
+    commands.add_parser('demo', help='write the demo images to output_images')
+
+    live = commands.add_parser('live', help='process a camera or a stream in real time')
+    live.add_argument('source', help='camera device number, stream URL or video file')
+    live.add_argument('--output', help='video file for the output')
+    live.add_argument('--show', action='store_true', help='show the output in a window')
+    live.add_argument('--latency-budget', type=float, help='seconds per frame')
+    add_profile_arguments(live)
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.print_help()
+        return 1
+    if args.threshold_tables is not None:
+        config.THRESHOLD_LOOKUP_TABLE_DIR = args.threshold_tables
+    camera_args = ([720, 1280, 3], args.calibration_images, 9, 6, args.calibration_store,
+                   args.camera_id)
+
+    if args.command == 'process':
+        if args.pipelined and (args.telemetry or args.no_render):
+            process.error('--pipelined does not record telemetry')
+        if args.pipelined and (args.profile_file is not None or args.track_allocations):
+            process.error('--pipelined only profiles its stages and queues, '
+                          'without --profile-file or --track-allocations')
+        if args.jobs is None:
+            args.jobs = max((os.cpu_count() or 1) // max(args.workers, 1), 1)
+        failed = process_video_files(expand_file_patterns(args.videos), camera_args,
+                                     args.jobs, args.workers, args.output_dir,
+                                     args.pipelined, args.force, args.frame_cache,
+                                     args.telemetry, not args.no_render, args.fourcc,
+                                     args.profile, args.profile_file, args.track_allocations)
+        return 1 if failed else 0
+
+    camera = Camera(*camera_args)
+    if args.command == 'demo':
+        create_demo_images(camera)
+    elif args.command == 'live':
+        source = int(args.source) if args.source.isdigit() else args.source
+        process_live_stream(source, camera, args.output, args.show, args.latency_budget,
+                            args.profile, args.track_allocations)
+    return 0
+
 
-create_demo_images(CAMERA)
-#process_test_images(CAMERA)
-process_video_file('project_video.mp4', CAMERA)
-process_video_file('challenge_video.mp4', CAMERA)
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,273 @@
+import collections
+import multiprocessing
+
+import cv2
+import numpy as np
+
+# My modules
+import config
+from lane import Lane
+from profiling import FrameProfiler, NULL_PROFILER
+import thresholding
+import lane_finding
+import lane_drawing
+
+
+class FrameContext:
+    # The buffers of every stage for frames of one shape, reused from frame
+    # to frame, and the renderer that keeps the overlay between them. With
+    # reuse_output the output frame is overwritten by the next one too.
+    def __init__(self, image_shape, reuse_output=True):
+        (height, width) = image_shape[0:2]
+        self.undist = np.empty((height, width, 3), np.uint8)
+        self.warped = np.empty((height, width, 3), np.uint8)
+        self.binary = np.zeros((height, width), np.uint8)
+        self.binary_warped = np.empty((height, width), np.uint8)
+        self.threshold_buffers = thresholding.ThresholdBuffers()
+        self.output = np.empty((height, width, 3), np.uint8) if reuse_output else None
+        self.renderer = lane_drawing.LaneRenderer()
+
+
+def threshold_and_warp(img, camera, mode=None, profiler=NULL_PROFILER, context=None,
+                       params=thresholding.DEFAULT_THRESHOLD_PARAMS):
+    if mode is None:
+        mode = config.THRESHOLD_MODE
+    if context is None:
+        context = FrameContext(img.shape, reuse_output=False)
+
+    if mode == 'warped':
+        with profiler.stage('warp'):
+            warped = camera.undistort_and_warp(img, cv2.INTER_LINEAR, context.warped)
+        with profiler.stage('threshold'):
+            return thresholding.threshold(warped, context.binary_warped,
+                                          context.threshold_buffers, params)
+
+    # Thresholding is per pixel, so thresholding the raw frame and remapping
+    # the binary is the same as a nearest neighbour remap of the color frame
+    with profiler.stage('threshold'):
+        if mode == 'region':
+            binary = thresholding.threshold_region(img, camera.warp_source_region, context.binary,
+                                                   context.threshold_buffers, params)
+        elif mode == 'full':
+            binary = thresholding.threshold(img, context.binary, context.threshold_buffers,
+                                            params)
+        else:
+            raise ValueError('Unknown threshold mode: ' + mode)
+    with profiler.stage('warp'):
+        return camera.undistort_and_warp(binary, dst=context.binary_warped)
+
+
+def prepare_frame(img, camera, profiler=NULL_PROFILER, context=None, undistort=True,
+                  mode=None):
+    # The stateless part of the pipeline, it can run in any process. Without
+    # undistort, undist is None, the undistorted frame is only drawn on.
+    if context is None:
+        context = FrameContext(img.shape, reuse_output=False)
+    undist = None
+    if undistort:
+        with profiler.stage('undistort'):
+            undist = camera.undistort(img, context.undist)
+    binary_warped = threshold_and_warp(img, camera, mode, profiler, context)
+    return undist, binary_warped
+
+
+def update_lane(binary_warped, lane_object, profiler=NULL_PROFILER, timestamp=None,
+                fast_search=False):
+    # The stateful part of the pipeline, it must see the frames in order
+    if timestamp is not None:
+        lane_object.set_time(timestamp)
+    try:
+        with profiler.stage('find_lane'):
+            (left_poly, right_poly, left_fitx, right_fitx, ploty,
+             left_moments, right_moments) = lane_finding.find_lane_polynomials_for_lane(
+                 binary_warped, lane_object, fast=fast_search)
+        with profiler.stage('lane_update'):
+            lane_object.update(left_fitx, right_fitx, ploty, left_poly, right_poly,
+                               left_moments, right_moments)
+    except Exception as e:
+        print('Exception:', e)
+        lane_object.update_insane()
+
+
+def update_lanes(streams, binary_warpeds, tracker, profiler=NULL_PROFILER, timestamps=None,
+                 fast_search=False):
+    # update_lane of a tick of a LaneTracker: the lanes are found in the
+    # frame of each stream, then all streams are updated at once
+    streams = np.asarray(streams, np.intp)
+    if timestamps is not None:
+        tracker.set_time(streams, timestamps)
+    found = []
+    results = []
+    with profiler.stage('find_lane'):
+        for stream, binary_warped in zip(streams, binary_warpeds):
+            try:
+                results.append(lane_finding.find_lane_polynomials_for_lane(
+                    binary_warped, tracker.lane(stream), fast=fast_search))
+                found.append(stream)
+            except Exception as e:
+                print('Exception:', e)
+    with profiler.stage('lane_update'):
+        tracker.update_insane(np.setdiff1d(streams, found))
+        if found:
+            (left_polys, right_polys, _, _, plot_ys,
+             left_moments, right_moments) = zip(*results)
+            tracker.update(found, plot_ys[0], left_polys, right_polys, left_moments,
+                           right_moments)
+
+
+def finish_frame(undist, binary_warped, camera, lane_object, profiler=NULL_PROFILER,
+                 context=None, timestamp=None, fast_search=False):
+    update_lane(binary_warped, lane_object, profiler, timestamp, fast_search)
+    with profiler.stage('draw'):
+        if context is None:
+            return lane_drawing.draw_all(undist, lane_object, camera)
+        return lane_drawing.draw_all(undist, lane_object, camera, context.renderer,
+                                     context.output)
+
+
+def process_image(img, camera, lane_object=None, profiler=NULL_PROFILER, context=None,
+                  timestamp=None, fast_search=False):
+    # fast_search is the fast path of live mode, see config.FAST_THRESHOLD_MODE
+    if lane_object is None:
+        lane_object = Lane(img.shape)
+
+    if fast_search:
+        _, binary_warped = prepare_frame(img, camera, profiler, context, False,
+                                         config.FAST_THRESHOLD_MODE)
+        undist = img
+    else:
+        undist, binary_warped = prepare_frame(img, camera, profiler, context)
+    return finish_frame(undist, binary_warped, camera, lane_object, profiler, context,
+                        timestamp, fast_search)
+
+
+# The camera and buffers of a worker process, set once by the pool initializer
+_worker_camera = None
+_worker_context = None
+
+def init_worker(camera):
+    # Initializer of the process pools of prepare_frame_in_worker
+    global _worker_camera, _worker_context
+    _worker_camera = camera
+    _worker_context = FrameContext(camera.image_shape, reuse_output=False)
+
+def prepare_frame_in_worker(img, profile, track_allocations, undistort=True):
+    # Returns the stage times too, as the profiler lives in the parent process
+    if not profile:
+        return prepare_frame(img, _worker_camera, context=_worker_context,
+                             undistort=undistort), None
+    profiler = FrameProfiler(track_allocations)
+    profiler.start_frame()
+    result = prepare_frame(img, _worker_camera, profiler, _worker_context, undistort)
+    return result, list(profiler.current_frame.items())
+
+
+def prepare_frames_parallel(frames, camera, workers, queue_depth, profiler=NULL_PROFILER,
+                            undistort=True):
+    # Yields the results of prepare_frame in the order of the frames,
+    # keeping at most queue_depth frames in flight
+    pool = multiprocessing.Pool(workers, init_worker, (camera,))
+    args = (profiler.enabled, getattr(profiler, 'track_allocations', False), undistort)
+    try:
+        pending = collections.deque()
+        for frame in frames:
+            if len(pending) >= queue_depth:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(prepare_frame_in_worker, (frame,) + args))
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def read_frames(frames, profiler):
+    frames = iter(frames)
+    while True:
+        with profiler.stage('read'):
+            frame = next(frames, None)
+        if frame is None:
+            return
+        yield frame
+
+
+def prepare_frames(frames, camera, workers=1, queue_depth=None, profiler=NULL_PROFILER,
+                   context=None, undistort=True):
+    # Yields (undist, binary_warped) of the frames in order, computed in a
+    # process pool with workers > 1. Serially they are in the context's buffers.
+    if workers > 1:
+        if queue_depth is None:
+            queue_depth = 2 * workers
+        prepared = prepare_frames_parallel(frames, camera, workers, queue_depth, profiler,
+                                           undistort)
+        for result, stage_times in prepared:
+            for name, (seconds, allocated_bytes) in stage_times or []:
+                profiler.record(name, seconds, allocated_bytes)
+            yield result
+    else:
+        for frame in frames:
+            yield prepare_frame(frame, camera, profiler, context, undistort)
+
+
+def finish_frames(prepared, camera, lane_object, profiler=NULL_PROFILER, context=None,
+                  telemetry=None):
+    # Yields the output frames of the (undist, binary_warped) pairs in order,
+    # recording the lane of each frame in telemetry if given.
+    # A profiler frame ends when the caller asks for the next output frame.
+    for undist, binary_warped in prepared:
+        output = finish_frame(undist, binary_warped, camera, lane_object, profiler, context)
+        if telemetry is not None:
+            with profiler.stage('telemetry'):
+                telemetry.record(lane_object)
+        yield output
+        profiler.end_frame()
+
+
+def process_frames(frames, camera, lane_object, workers=1, queue_depth=None,
+                   profiler=NULL_PROFILER, context=None, telemetry=None):
+    # Yields the output frames in order. With workers > 1 the stateless
+    # stages run in a process pool, the lane update and drawing stay here.
+    frames = read_frames(frames, profiler)
+    if context is None:
+        context = FrameContext(camera.image_shape, reuse_output=False)
+    prepared = prepare_frames(frames, camera, workers, queue_depth, profiler, context)
+    return finish_frames(prepared, camera, lane_object, profiler, context, telemetry)
+
+
+def write_frames(frames, sink, profiler=NULL_PROFILER):
+    # Returns the number of frames
+    frame_count = 0
+    for frame in frames:
+        with profiler.stage('write'):
+            sink.write(frame)
+        frame_count += 1
+    return frame_count
+
+
+def process_stream(source, sink, camera, workers=1, queue_depth=None,
+                   profiler=NULL_PROFILER, telemetry=None):
+    # Processes all frames of a frame_io source into a sink, which is done
+    # with each frame before the next one, so the output buffer is reused.
+    # Returns the number of frames.
+    lane_object = Lane(camera.image_shape)
+    context = FrameContext(camera.image_shape)
+    return write_frames(process_frames(source, camera, lane_object, workers, queue_depth,
+                                       profiler, context, telemetry), sink, profiler)
+
+
+def process_stream_telemetry(source, telemetry, camera, workers=1, queue_depth=None,
+                             profiler=NULL_PROFILER):
+    # The no-render mode: only finds the lanes of a frame_io source and
+    # records them in telemetry, without undistorting, drawing or encoding.
+    # Returns the number of frames.
+    lane_object = Lane(camera.image_shape)
+    context = FrameContext(camera.image_shape, reuse_output=False)
+    frames = read_frames(source, profiler)
+    frame_count = 0
+    for _, binary_warped in prepare_frames(frames, camera, workers, queue_depth, profiler,
+                                           context, undistort=False):
+        update_lane(binary_warped, lane_object, profiler)
+        with profiler.stage('telemetry'):
+            telemetry.record(lane_object)
+        profiler.end_frame()
+        frame_count += 1
+    return frame_count
@@ -0,0 +1,63 @@
+"""
+Least squares fitting of x = a * y^2 + b * y + c from running sums
+"""
+
+import numpy as np
+
+
+class PolyMoments:
+    # The sums of the normal equations of a weighted least squares fit.
+    # Adding pixels is O(n), merging and forgetting frames is O(1).
+    def __init__(self, y_scale=1.0):
+        # y is divided by y_scale, keeping the sums of y^4 well conditioned
+        self.y_scale = float(y_scale)
+        self.y_moments = np.zeros(5)  # sum of w * u^k for k = 0..4, u = y / y_scale
+        self.xy_moments = np.zeros(3)  # sum of w * x * u^k for k = 0..2
+
+    @classmethod
+    def from_pixels(cls, x, y, y_scale=1.0):
+        moments = cls(y_scale)
+        moments.add_pixels(x, y)
+        return moments
+
+    def copy(self):
+        moments = PolyMoments(self.y_scale)
+        moments.y_moments = self.y_moments.copy()
+        moments.xy_moments = self.xy_moments.copy()
+        return moments
+
+    def add_pixels(self, x, y, weight=1.0):
+        x = np.asarray(x, np.float64)
+        u = np.asarray(y, np.float64) / self.y_scale
+        u2 = u * u
+        self.y_moments += weight * np.array(
+            [len(u), u.sum(), u2.sum(), u2.dot(u), u2.dot(u2)])
+        self.xy_moments += weight * np.array([x.sum(), x.dot(u), x.dot(u2)])
+
+    def add(self, other, weight=1.0):
+        assert self.y_scale == other.y_scale
+        self.y_moments += weight * other.y_moments
+        self.xy_moments += weight * other.xy_moments
+
+    def decay(self, factor):
+        # Exponential forgetting, the weight of everything added so far
+        # is multiplied by factor
+        self.y_moments *= factor
+        self.xy_moments *= factor
+
+    def count(self):
+        return self.y_moments[0]
+
+    def solve(self):
+        # [a, b, c] in pixel coordinates, like np.polyfit(y, x, 2)
+        return solve_moments(self.y_moments, self.xy_moments, self.y_scale)
+
+
+def solve_moments(y_moments, xy_moments, y_scale=1.0):
+    # PolyMoments.solve for stacked sums, y_moments (..., 5) and xy_moments
+    # (..., 3), e.g. of many lines at once. Returns [a, b, c] in (..., 3).
+    s = np.asarray(y_moments, np.float64)
+    normal_matrices = np.stack([s[..., [4, 3, 2]], s[..., [3, 2, 1]], s[..., [2, 1, 0]]], -2)
+    rhs = np.asarray(xy_moments, np.float64)[..., ::-1, np.newaxis]
+    solution = np.linalg.solve(normal_matrices, rhs)[..., 0]
+    return solution / np.array([y_scale ** 2, y_scale, 1.0])
@@ -0,0 +1,153 @@
+"""
+Per-stage timing of the frame pipeline
+"""
+
+import collections
+import contextlib
+import csv
+import json
+import time
+import tracemalloc
+
+import numpy as np
+
+
+class NullProfiler:
+    # Used when profiling is disabled, every call is a no-op
+    enabled = False
+
+    def __init__(self):
+        self._null_context = contextlib.nullcontext()
+
+    def start_frame(self):
+        pass
+
+    def end_frame(self):
+        pass
+
+    def stage(self, name):
+        return self._null_context
+
+    def record(self, name, seconds, allocated_bytes=0):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class FrameProfiler:
+    enabled = True
+
+    def __init__(self, track_allocations=False):
+        # With track_allocations the peak of the memory allocated by each
+        # stage is measured with tracemalloc, which slows the pipeline down
+        self.track_allocations = track_allocations
+        if track_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        self.frames = []
+        self.current_frame = None
+        self.frame_start_time = None
+        self.start_time = None
+        self.end_time = None
+
+    def start_frame(self):
+        # Called implicitly by the first stage of a frame too
+        self.frame_start_time = time.perf_counter()
+        if self.start_time is None:
+            self.start_time = self.frame_start_time
+        self.current_frame = collections.OrderedDict()
+
+    def end_frame(self):
+        if self.current_frame is None:
+            return
+        self.end_time = time.perf_counter()
+        self.record('frame', self.end_time - self.frame_start_time)
+        self.frames.append(self.current_frame)
+        self.current_frame = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.current_frame is None:
+            self.start_frame()
+        if self.track_allocations:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            allocated_bytes = 0
+            if self.track_allocations:
+                allocated_bytes = tracemalloc.get_traced_memory()[1] - start_memory
+            self.record(name, seconds, allocated_bytes)
+
+    def record(self, name, seconds, allocated_bytes=0):
+        if self.current_frame is None:
+            self.start_frame()
+        (old_seconds, old_bytes) = self.current_frame.get(name, (0.0, 0))
+        self.current_frame[name] = (old_seconds + seconds, old_bytes + allocated_bytes)
+
+    def stage_names(self):
+        names = []
+        for frame in self.frames:
+            for name in frame:
+                if name not in names:
+                    names.append(name)
+        return names
+
+    def summary(self):
+        summary = collections.OrderedDict()
+        for name in self.stage_names():
+            seconds = np.array([frame[name][0] for frame in self.frames if name in frame])
+            allocated = np.array([frame[name][1] for frame in self.frames if name in frame])
+            p50, p95, p99 = np.percentile(seconds * 1000, [50, 95, 99])
+            summary[name] = collections.OrderedDict([
+                ('p50_ms', p50), ('p95_ms', p95), ('p99_ms', p99),
+                ('mean_ms', seconds.mean() * 1000)])
+            if self.track_allocations:
+                summary[name]['mean_allocated_bytes'] = allocated.mean()
+        return summary
+
+    def fps(self):
+        if not self.frames or self.end_time == self.start_time:
+            return 0.0
+        return len(self.frames) / (self.end_time - self.start_time)
+
+    def print_summary(self, title=None):
+        # Printed at once, so the summaries of parallel jobs do not mix.
+        # The allocations are only shown when they are tracked.
+        lines = [] if title is None else [title]
+        header = '{0:<20} {1:>9} {2:>9} {3:>9}'.format('Stage', 'p50 ms', 'p95 ms', 'p99 ms')
+        if self.track_allocations:
+            header += ' {0:>12}'.format('alloc KB')
+        lines.append(header)
+        for name, stats in self.summary().items():
+            line = '{0:<20} {1:9.2f} {2:9.2f} {3:9.2f}'.format(
+                name, stats['p50_ms'], stats['p95_ms'], stats['p99_ms'])
+            if self.track_allocations:
+                line += ' {0:12.0f}'.format(stats['mean_allocated_bytes'] / 1024)
+            lines.append(line)
+        lines.append('{0} frames, {1:.1f} fps'.format(len(self.frames), self.fps()))
+        print('\n'.join(lines))
+
+    def write_frames(self, file_name):
+        # Per-frame stage times in milliseconds, as .json or .csv
+        names = self.stage_names()
+        byte_names = names if self.track_allocations else []
+        rows = [collections.OrderedDict(
+                    [('frame', i)] +
+                    [(name + '_ms', frame[name][0] * 1000) for name in names if name in frame] +
+                    [(name + '_bytes', frame[name][1]) for name in byte_names if name in frame])
+                for i, frame in enumerate(self.frames)]
+        if file_name.endswith('.json'):
+            with open(file_name, 'w') as f:
+                json.dump({'summary': self.summary(), 'fps': self.fps(), 'frames': rows}, f, indent=1)
+        else:
+            fields = (['frame'] + [name + '_ms' for name in names] +
+                      [name + '_bytes' for name in byte_names])
+            with open(file_name, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fields)
+                writer.writeheader()
+                writer.writerows(rows)
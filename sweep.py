@@ -0,0 +1,235 @@
+"""
+Parameter sweep of the thresholds and the lane sanity limits over a clip
+
+    python sweep.py cuts/cut.mp4 --hue-min 15 20 25 --lightness-min 190 200 210 \
+        --output sweep.csv
+
+Every combination of the given values is run through lane finding and
+tracking, without rendering. The frames are decoded once, and in the 'warped'
+threshold mode also undistorted and warped once, into a temporary raw file
+that the worker processes map. Each configuration is scored by its rate of
+sane frames and the stability of its fits.
+"""
+
+import argparse
+import collections
+import csv
+import itertools
+import math
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+# My modules
+import config
+from camera import Camera
+from frame_cache import RawArrayWriter, read_raw_array
+from frame_io import VideoCaptureSource
+from lane import Lane, SanityLimits, DEFAULT_SANITY_LIMITS
+import lane_finding
+import pipeline
+import thresholding
+from thresholding import ThresholdParams, DEFAULT_THRESHOLD_PARAMS
+
+# The mean frame to frame change of the fitted lines, in pixels, that halves the score
+JITTER_SCALE_PX = 10.0
+
+
+class SweepRun:
+    # Lane tracking of one configuration over the frames
+    def __init__(self, image_shape, threshold_params, sanity_limits):
+        self.threshold_params = threshold_params
+        self.sanity_limits = sanity_limits
+        self.lane = Lane(image_shape, sanity_limits=sanity_limits)
+        self.frames = 0
+        self.sane_frames = 0
+        self.valid_frames = 0
+        self.failures = 0
+        self.jitter_sum = 0.0
+        self.jitter_count = 0
+        self.last_fit_x = None
+
+    def update(self, binary_warped):
+        self.frames += 1
+        try:
+            (left_poly, right_poly, left_fitx, right_fitx, ploty,
+             left_moments, right_moments) = lane_finding.find_lane_polynomials_for_lane(
+                 binary_warped, self.lane)
+        except Exception:
+            self.failures += 1
+            self.lane.update_insane()
+            self.valid_frames += self.lane.is_valid()
+            self.last_fit_x = None
+            return
+        self.lane.update(left_fitx, right_fitx, ploty, left_poly, right_poly,
+                         left_moments, right_moments)
+        self.valid_frames += self.lane.is_valid()
+        if not self.lane.is_up_to_date():
+            self.last_fit_x = None
+            return
+
+        # Stability: how much the fits of consecutive sane frames differ
+        self.sane_frames += 1
+        fit_x = np.concatenate([left_fitx, right_fitx])
+        if self.last_fit_x is not None:
+            self.jitter_sum += np.mean(np.abs(fit_x - self.last_fit_x))
+            self.jitter_count += 1
+        self.last_fit_x = fit_x
+
+    def result(self):
+        sane_rate = self.sane_frames / self.frames if self.frames else 0.0
+        jitter = self.jitter_sum / self.jitter_count if self.jitter_count else float('nan')
+        score = sane_rate / (1 + jitter / JITTER_SCALE_PX) if self.jitter_count else 0.0
+        result = collections.OrderedDict()
+        result.update(self.threshold_params._asdict())
+        result.update(self.sanity_limits._asdict())
+        result.update([('frames', self.frames), ('sane_rate', sane_rate),
+                       ('valid_rate', self.valid_frames / self.frames if self.frames else 0.0),
+                       ('failures', self.failures), ('jitter_px', jitter), ('score', score)])
+        return result
+
+
+def prepare_sweep_frames(frames, camera, mode, file_name):
+    # Writes what thresholding starts from to a raw file: the frames, or in
+    # the 'warped' mode the undistorted and warped frames
+    writer = RawArrayWriter(file_name, {'mode': mode})
+    try:
+        for frame in frames:
+            if mode == 'warped':
+                frame = camera.undistort_and_warp(frame, cv2.INTER_LINEAR)
+            writer.append(frame)
+        writer.commit()
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.rows
+
+
+# The camera and frames of a worker process, set once by the pool initializer
+_sweep_camera = None
+_sweep_frames = None
+_sweep_mode = None
+
+def _init_sweep_worker(camera_args, frames_file_name, mode):
+    global _sweep_camera, _sweep_frames, _sweep_mode
+    # Most tables are used by one task only, storing them would leave 2 MB
+    # files behind for every configuration
+    config.THRESHOLD_LOOKUP_TABLE_DIR = None
+    _sweep_camera = Camera(*camera_args)
+    _sweep_frames = read_raw_array(frames_file_name)[1]
+    _sweep_mode = mode
+
+def _run_sweep_task(threshold_params, sanity_limits_list):
+    # The runs share the thresholded frames, they only differ in tracking
+    camera = _sweep_camera
+    context = pipeline.FrameContext(camera.image_shape, reuse_output=False)
+    runs = [SweepRun(camera.image_shape, threshold_params, limits)
+            for limits in sanity_limits_list]
+    for frame in _sweep_frames:
+        if _sweep_mode == 'warped':
+            binary_warped = thresholding.threshold(frame, context.binary_warped,
+                                                   context.threshold_buffers, threshold_params)
+        else:
+            binary_warped = pipeline.threshold_and_warp(frame, camera, _sweep_mode,
+                                                        context=context, params=threshold_params)
+        for run in runs:
+            run.update(binary_warped)
+    # Every configuration has its own 16 MB table
+    thresholding.release_lookup_table(threshold_params)
+    return [run.result() for run in runs]
+
+
+def make_tasks(threshold_grid, sanity_grid, workers):
+    # One task per threshold configuration, split by the sanity limits until
+    # there are enough tasks for the workers
+    chunks = max(1, int(math.ceil(2.0 * workers / len(threshold_grid))))
+    chunk_size = max(1, int(math.ceil(len(sanity_grid) / float(chunks))))
+    return [(params, sanity_grid[i:i + chunk_size])
+            for params in threshold_grid for i in range(0, len(sanity_grid), chunk_size)]
+
+
+def run_sweep(file_name, camera_args, threshold_grid, sanity_grid, workers=None,
+              max_frames=None, mode=None):
+    # Returns the results of all configurations, best score first
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if mode is None:
+        mode = config.THRESHOLD_MODE
+    camera = Camera(*camera_args)
+
+    temp_dir = tempfile.mkdtemp(prefix='sweep_')
+    try:
+        frames_file_name = os.path.join(temp_dir, 'frames.raw')
+        with VideoCaptureSource(file_name) as source:
+            frames = itertools.islice(source, max_frames)
+            prepare_sweep_frames(frames, camera, mode, frames_file_name)
+
+        tasks = make_tasks(threshold_grid, sanity_grid, workers)
+        pool = multiprocessing.Pool(workers, _init_sweep_worker,
+                                    (camera_args, frames_file_name, mode))
+        try:
+            results = [result for task_results in pool.starmap(_run_sweep_task, tasks)
+                       for result in task_results]
+        finally:
+            pool.terminate()
+    finally:
+        shutil.rmtree(temp_dir)
+
+    results.sort(key=lambda result: result['score'], reverse=True)
+    return results
+
+
+def write_results(results, file_name):
+    with open(file_name, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def print_results(results, count=None):
+    names = list(results[0].keys())
+    print(' '.join('{0:>14}'.format(name) for name in names))
+    for result in results[:count]:
+        print(' '.join('{0:14.3f}'.format(value) if isinstance(value, float)
+                       else '{0:>14}'.format(value) for value in result.values()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('video')
+    for name, value in DEFAULT_THRESHOLD_PARAMS._asdict().items():
+        parser.add_argument('--' + name.replace('_', '-'), type=int, nargs='+', default=[value])
+    for name, value in DEFAULT_SANITY_LIMITS._asdict().items():
+        parser.add_argument('--' + name.replace('_', '-'), type=int, nargs='+',
+                            default=[value], help='sanity limit in pixels')
+    parser.add_argument('--max-frames', type=int)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--top', type=int, default=20, help='number of results printed')
+    parser.add_argument('--output', help='CSV file for all results')
+    parser.add_argument('--calibration-store', default='camera_calibration')
+    args = parser.parse_args(argv)
+
+    threshold_grid = [ThresholdParams(*values) for values in itertools.product(
+        *[getattr(args, name) for name in ThresholdParams._fields])]
+    sanity_grid = [SanityLimits(*values) for values in itertools.product(
+        *[getattr(args, name) for name in SanityLimits._fields])]
+    camera_args = ([720, 1280, 3], 'camera_cal/calibration*.jpg', 9, 6, args.calibration_store)
+
+    start = time.perf_counter()
+    results = run_sweep(args.video, camera_args, threshold_grid, sanity_grid, args.workers,
+                        args.max_frames)
+    print_results(results, args.top)
+    print('{0} configurations in {1:.1f} s'.format(len(results), time.perf_counter() - start))
+    if args.output is not None:
+        write_results(results, args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
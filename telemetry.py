@@ -0,0 +1,122 @@
+"""
+Per-frame lane telemetry in columns
+
+A telemetry file is a directory with one column per field of
+TELEMETRY_FIELDS, each a raw array file of frame_cache.RawArrayWriter:
+
+    <video>_lanes.telemetry/<field>.raw
+
+The values are collected in preallocated column chunks, which are appended
+to the column files when they are full. The directory is written under a
+temporary name and renamed when it is complete. read_telemetry maps the
+columns back, one array per field.
+"""
+
+import collections
+import os
+import shutil
+
+import numpy as np
+
+from frame_cache import RawArrayWriter, read_raw_array
+
+FORMAT_VERSION = 2
+
+# (name, dtype, shape of a frame's value). Before the first sane frame the
+# polynomials and lane values are NaN. sane is whether this frame's fit
+# passed the sanity check, valid whether the lane is drawn at all.
+TELEMETRY_FIELDS = [
+    ('frame', np.int64, ()),
+    ('left_poly', np.float64, (3,)),
+    ('right_poly', np.float64, (3,)),
+    ('radius_of_curvature_m', np.float64, ()),
+    ('relative_car_position_m', np.float64, ()),
+    ('age', np.float32, ()),
+    ('sane', np.bool_, ()),
+    ('valid', np.bool_, ()),
+]
+
+
+def get_telemetry_file_name(file_name, output_dir=None):
+    out_file_name = os.path.splitext(file_name)[0] + '_lanes.telemetry'
+    if output_dir is not None:
+        out_file_name = os.path.join(output_dir, os.path.basename(out_file_name))
+    return out_file_name
+
+
+class TelemetryWriter:
+    # close() completes the file, replacing an existing one, abort() drops it
+    def __init__(self, file_name, fps, source=None, chunk_size=1024):
+        self.file_name = file_name
+        self.temp_file_name = file_name + '.part'
+        self.columns = collections.OrderedDict(
+            (name, np.zeros((chunk_size,) + shape, dtype))
+            for name, dtype, shape in TELEMETRY_FIELDS)
+        self.rows = 0
+        self.frame = 0
+
+        shutil.rmtree(self.temp_file_name, ignore_errors=True)
+        os.makedirs(self.temp_file_name)
+        header = {'version': FORMAT_VERSION, 'fps': fps, 'source': source}
+        self.writers = [RawArrayWriter(os.path.join(self.temp_file_name, name + '.raw'), header)
+                        for name in self.columns]
+
+    def record(self, lane_object):
+        columns = self.columns
+        row = self.rows
+        columns['frame'][row] = self.frame
+        if lane_object.left_poly is None:
+            columns['left_poly'][row] = np.nan
+            columns['right_poly'][row] = np.nan
+        else:
+            columns['left_poly'][row] = lane_object.left_poly
+            columns['right_poly'][row] = lane_object.right_poly
+        columns['radius_of_curvature_m'][row] = _or_nan(lane_object.radius_of_curvature_m)
+        columns['relative_car_position_m'][row] = _or_nan(lane_object.relative_car_position_m)
+        columns['age'][row] = lane_object.age
+        columns['sane'][row] = lane_object.is_up_to_date()
+        columns['valid'][row] = lane_object.is_valid()
+
+        self.frame += 1
+        self.rows += 1
+        if self.rows == len(columns['frame']):
+            self.flush()
+
+    def flush(self):
+        for writer, column in zip(self.writers, self.columns.values()):
+            writer.extend(column[:self.rows])
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+        for writer in self.writers:
+            writer.commit()
+        shutil.rmtree(self.file_name, ignore_errors=True)
+        os.replace(self.temp_file_name, self.file_name)
+
+    def abort(self):
+        for writer in self.writers:
+            writer.abort()
+        shutil.rmtree(self.temp_file_name, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _or_nan(value):
+    return np.nan if value is None else value
+
+
+def read_telemetry(file_name):
+    # Returns (header, columns), the columns memory-mapped, by field name
+    columns = collections.OrderedDict()
+    for name, _, _ in TELEMETRY_FIELDS:
+        (header, columns[name]) = read_raw_array(os.path.join(file_name, name + '.raw'))
+    header = {key: value for key, value in header.items() if key not in ('shape', 'dtype')}
+    return header, columns
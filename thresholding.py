@@ -1,30 +1,168 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import namedtuple
+
 import numpy as np
 import cv2
 
 import config
 
-def boolean_to_binary(boolean_array):
-    binary = np.zeros_like(boolean_array, float)
-    binary[boolean_array] = 1
-    return binary
+ThresholdParams = namedtuple(
+    'ThresholdParams', ['hue_min', 'hue_max', 'saturation_min', 'lightness_min'])
+
+# H in [20, 40] and S >= 30 is yellow, L >= 200 is white, in OpenCV's uint8 HLS
+DEFAULT_THRESHOLD_PARAMS = ThresholdParams(hue_min=20, hue_max=40,
+                                           saturation_min=30, lightness_min=200)
+
+# Changing how the lookup tables are built invalidates the stored ones
+LOOKUP_TABLE_VERSION = 1
+
+# Lookup tables by threshold parameters, the lock keeps threads from
+# building the same table at once
+_lookup_tables = {}
+_lookup_tables_lock = threading.Lock()
+
+def pack_binary(binary):
+    # 8 pixels per byte, for storing and dumping binary images
+    return np.packbits(binary, axis=-1)
+
+def unpack_binary(packed, width):
+    return np.unpackbits(packed, axis=-1, count=width)
+
+def save_binary(file_name, binary):
+    np.savez(file_name, packed=pack_binary(binary), width=binary.shape[-1])
+
+def load_binary(file_name):
+    data = np.load(file_name)
+    return unpack_binary(data['packed'], int(data['width']))
+
+def threshold_region(img, region, dst=None, buffers=None, params=DEFAULT_THRESHOLD_PARAMS):
+    # Threshold only inside region = (y_low, y_high, x_low, x_high),
+    # the rest of the binary image stays 0
+    (y_low, y_high, x_low, x_high) = region
+    if dst is None:
+        dst = np.zeros(img.shape[0:2], np.uint8)
+    else:
+        dst[0:y_low] = 0
+        dst[y_high:] = 0
+        dst[y_low:y_high, 0:x_low] = 0
+        dst[y_low:y_high, x_high:] = 0
+    threshold(img[y_low:y_high, x_low:x_high], dst[y_low:y_high, x_low:x_high], buffers, params)
+    return dst
+
+def threshold_batch(imgs, region=None, params=DEFAULT_THRESHOLD_PARAMS):
+    # Thresholds a (N, H, W, 3) batch of frames with one color conversion
+    if region is not None:
+        (y_low, y_high, x_low, x_high) = region
+        binary = np.zeros(imgs.shape[0:3], np.uint8)
+        binary[:, y_low:y_high, x_low:x_high] = threshold_batch(
+            imgs[:, y_low:y_high, x_low:x_high], params=params)
+        return binary
+
+    # Frames stacked vertically are a single image for cvtColor
+    (n, height, width) = imgs.shape[0:3]
+    stacked = np.ascontiguousarray(imgs).reshape(n * height, width, 3)
+    return threshold(stacked, params=params).reshape(n, height, width)
 
-def threshold(img):
-    hls = cv2.cvtColor(img, cv2.COLOR_RGB2HLS).astype(np.float)
+class ThresholdBuffers:
+    # Work buffers of threshold, allocated once per name and shape
+    def __init__(self):
+        self.buffers = {}
 
-    h_channel = hls[:, :, 0]
-    l_channel = hls[:, :, 1]
-    s_channel = hls[:, :, 2]
+    def get(self, name, shape, dtype=np.uint8):
+        key = (name, tuple(shape))
+        if key not in self.buffers:
+            self.buffers[key] = np.empty(shape, dtype)
+        return self.buffers[key]
 
-    yellow = (h_channel >= 20) & (h_channel <= 40) & (s_channel >= 30)
-    white = (l_channel >= 200)
+def threshold_hls(img, dst=None, buffers=None, params=DEFAULT_THRESHOLD_PARAMS):
+    # The reference thresholding, the lookup tables are built from it
+    if buffers is None:
+        buffers = ThresholdBuffers()
+    shape = img.shape[0:2]
+    hls = buffers.get('hls', shape + (3,))
+    yellow = buffers.get('yellow', shape)
+    white = buffers.get('white', shape)
+    if dst is None:
+        dst = np.empty(shape, np.uint8)
 
-    white_binary = boolean_to_binary(white)
-    white_or_yellow_binary = boolean_to_binary(white | yellow)
+    cv2.cvtColor(img, cv2.COLOR_RGB2HLS, dst=hls)
+
+    # Yellow is a hue range with some saturation, white is a high lightness
+    cv2.inRange(hls, (params.hue_min, 0, params.saturation_min),
+                (params.hue_max, 255, 255), dst=yellow)
+    cv2.inRange(hls, (0, params.lightness_min, 0), (255, 255, 255), dst=white)
+
+    # inRange gives 0 or 255
+    cv2.bitwise_or(white, yellow, dst=dst)
+    cv2.bitwise_and(dst, 1, dst=dst)
 
     if config.VISUALIZE_THRESHOLD:
-        color = np.dstack((white_binary, white_or_yellow_binary, white_or_yellow_binary))
+        color = np.dstack((white, dst * 255, dst * 255))
         cv2.imshow('debug', color)
         if cv2.waitKey() % 256 == 27:
             exit()
 
-    return white_or_yellow_binary
+    return dst
+
+def lookup_table_file_name(params):
+    key = hashlib.sha1(json.dumps([LOOKUP_TABLE_VERSION] + list(params)).encode())
+    return os.path.join(config.THRESHOLD_LOOKUP_TABLE_DIR,
+                        'threshold_{0}.npy'.format(key.hexdigest()[:16]))
+
+def build_lookup_table(params):
+    # Thresholds an image of all 2^24 colors, ordered like the indices of threshold
+    colors = np.arange(1 << 24, dtype='<u4').view(np.uint8).reshape(4096, 4096, 4)
+    rgb = np.ascontiguousarray(colors[:, :, 0:3])
+    return threshold_hls(rgb, params=params).ravel()
+
+def get_lookup_table(params=DEFAULT_THRESHOLD_PARAMS):
+    # One byte per RGB color, 16 MB in memory and 2 MB on disk as bits
+    table = _lookup_tables.get(params)
+    if table is not None:
+        return table
+
+    with _lookup_tables_lock:
+        if params in _lookup_tables:
+            return _lookup_tables[params]
+        file_name = None
+        if config.THRESHOLD_LOOKUP_TABLE_DIR is not None:
+            file_name = lookup_table_file_name(params)
+        if file_name is not None and os.path.exists(file_name):
+            table = np.unpackbits(np.load(file_name))
+        else:
+            table = build_lookup_table(params)
+            if file_name is not None:
+                os.makedirs(os.path.dirname(file_name), exist_ok=True)
+                (handle, temp_file_name) = tempfile.mkstemp(
+                    suffix='.npy', dir=os.path.dirname(file_name))
+                with os.fdopen(handle, 'wb') as f:
+                    np.save(f, np.packbits(table))
+                os.replace(temp_file_name, file_name)
+
+        _lookup_tables[params] = table
+        return table
+
+def release_lookup_table(params):
+    # Frees the memory of a table, it is loaded again when needed
+    with _lookup_tables_lock:
+        _lookup_tables.pop(params, None)
+
+def threshold(img, dst=None, buffers=None, params=DEFAULT_THRESHOLD_PARAMS):
+    # Same result as threshold_hls, with one table lookup per pixel
+    if config.VISUALIZE_THRESHOLD:
+        return threshold_hls(img, dst, buffers, params)
+    if buffers is None:
+        buffers = ThresholdBuffers()
+    shape = img.shape[0:2]
+    rgba = buffers.get('rgba', shape + (4,))
+    index = buffers.get('index', shape, np.intp)
+    table = get_lookup_table(params)
+
+    # The R, G and B bytes of a pixel are its index
+    cv2.cvtColor(img, cv2.COLOR_RGB2RGBA, dst=rgba)
+    np.bitwise_and(rgba.view('<u4')[:, :, 0], 0xFFFFFF, out=index)
+    return np.take(table, index, out=dst, mode='clip')